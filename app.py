@@ -1,12 +1,36 @@
 import os
 import logging
-from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, jsonify
+import mimetypes
+from datetime import datetime
+from urllib.parse import quote
+from flask import (Flask, Response, render_template, request, redirect, url_for, flash, send_file, jsonify,
+                   stream_with_context, abort)
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
+from sqlalchemy import func
 from models import db, User, Role, Book, Genre, Cover, Review, Collection
-import hashlib
+import queries
+from pagination import review_page, book_page, catalog_count, BOOKS_PER_PAGE
+import search
+import cover_storage
+import thumbnails
+import tasks
+import importer
+import export
+import migrations
+import database
+import collection_books
+from instrumentation import Instrumentation, sample
+import passwords
+from page_cache import PageCache, create_backend, current_role
+from identity import IdentityCache, roles
+from permissions import (Permission, permission_required, can,
+                         ADMIN_ROLE, MODERATOR_ROLE, USER_ROLE)
+from facets import CatalogFilter, facet_counts
+import click
 import bleach
-import markdown
+from rendering import render_markdown, cached_markdown
 from dotenv import load_dotenv
 
 # Настройка логирования
@@ -20,7 +44,7 @@ app = Flask(__name__)
 # Конфигурация базы данных
 if 'DATABASE_URL' in os.environ:
     # Для Render
-    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL'].replace('postgres://', 'postgresql://')
+    app.config['SQLALCHEMY_DATABASE_URI'] = database.normalize_url(os.environ['DATABASE_URL'])
     logger.info("Using PostgreSQL database from DATABASE_URL")
 else:
     # Для локальной разработки
@@ -28,188 +52,244 @@ else:
     logger.info("Using SQLite database")
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Пул соединений одного воркера: не больше DB_POOL_SIZE + DB_MAX_OVERFLOW соединений
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+app.config['DB_POOL_TIMEOUT'] = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+# Ограничение времени запроса PostgreSQL, мс (0 — без ограничения)
+app.config['DB_STATEMENT_TIMEOUT'] = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+# Внешний пулер соединений: '' (нет) или 'transaction' (PgBouncer в режиме transaction)
+app.config['DB_POOLER'] = os.environ.get('DB_POOLER', '')
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = database.engine_options(
+    app.config['SQLALCHEMY_DATABASE_URI'],
+    pool_size=app.config['DB_POOL_SIZE'],
+    max_overflow=app.config['DB_MAX_OVERFLOW'],
+    pool_timeout=app.config['DB_POOL_TIMEOUT'],
+    pool_recycle=app.config['DB_POOL_RECYCLE'],
+    pre_ping=app.config['DB_POOL_PRE_PING'],
+    statement_timeout=app.config['DB_STATEMENT_TIMEOUT'],
+    pooler=app.config['DB_POOLER'],
+)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev')
 app.config['UPLOAD_FOLDER'] = 'covers'
 app.config['STATIC_COVERS_FOLDER'] = 'static/covers'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max-limit
+# Пагинация каталога: 'offset' (номера страниц) или 'keyset' (курсоры)
+app.config['CATALOG_PAGINATION'] = os.environ.get('CATALOG_PAGINATION', 'offset')
+# Подсчёт книг для номеров страниц: 'exact', 'cached' или 'estimate'
+app.config['CATALOG_COUNT'] = os.environ.get('CATALOG_COUNT', 'exact')
+app.config['CATALOG_COUNT_TTL'] = int(os.environ.get('CATALOG_COUNT_TTL', 60))
+app.config['FACET_CACHE_TTL'] = int(os.environ.get('FACET_CACHE_TTL', 60))
+# Отдача файлов обложек фронтенд-сервером: '' (сам Flask), 'x-accel' (nginx) или 'x-sendfile'
+app.config['COVER_SENDFILE'] = os.environ.get('COVER_SENDFILE', '')
+# Internal-location nginx, отображённый на рабочий каталог приложения (для x-accel)
+app.config['COVER_ACCEL_PREFIX'] = os.environ.get('COVER_ACCEL_PREFIX', '/_protected/')
+app.config['USE_X_SENDFILE'] = app.config['COVER_SENDFILE'] == 'x-sendfile'
+COVER_MAX_AGE = 365 * 24 * 60 * 60
+# Дисковый кэш уменьшенных копий обложек
+app.config['THUMBNAIL_FOLDER'] = os.environ.get('THUMBNAIL_FOLDER', 'thumbnails')
+app.config['THUMBNAIL_CACHE_MAX_BYTES'] = int(os.environ.get('THUMBNAIL_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+# Фоновые задачи: 'thread' (пул потоков в процессе приложения) или 'worker' (отдельный `flask worker`)
+app.config['TASK_MODE'] = os.environ.get('TASK_MODE', 'thread')
+app.config['TASK_WORKER_THREADS'] = int(os.environ.get('TASK_WORKER_THREADS', 2))
+# Кэш страниц: '' (выключен), 'memory' (только для одного процесса), 'filesystem' или 'redis'
+app.config['PAGE_CACHE'] = os.environ.get('PAGE_CACHE', '')
+app.config['PAGE_CACHE_FOLDER'] = os.environ.get('PAGE_CACHE_FOLDER', 'page_cache')
+app.config['PAGE_CACHE_URL'] = os.environ.get('PAGE_CACHE_URL', 'redis://localhost:6379/0')
+app.config['PAGE_CACHE_TTL'] = int(os.environ.get('PAGE_CACHE_TTL', 300))
+# Время жизни снимка пользователя с ролью в кэше процесса
+app.config['IDENTITY_CACHE_TTL'] = int(os.environ.get('IDENTITY_CACHE_TTL', 60))
+# Хеширование паролей: метод werkzeug с параметрами; хеши по старому методу пересчитываются при входе
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', passwords.DEFAULT_METHOD)
+# Не больше PASSWORD_HASH_WORKERS хешей одновременно и PASSWORD_HASH_QUEUE в очереди на процесс
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_QUEUE'] = int(os.environ.get('PASSWORD_HASH_QUEUE', 8))
+# Попыток входа в минуту с одного IP-адреса и для одного логина (0 — без ограничения).
+# За прокси (Render, nginx) укажите TRUSTED_PROXIES — число прокси перед приложением:
+# адрес клиента возьмётся из X-Forwarded-For, иначе все клиенты делят лимит адреса прокси
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+app.config['LOGIN_RATE_PER_IP'] = int(os.environ.get('LOGIN_RATE_PER_IP', 20))
+app.config['LOGIN_RATE_PER_LOGIN'] = int(os.environ.get('LOGIN_RATE_PER_LOGIN', 5))
+# Метрики запросов: порог медленного запроса, мс (0 — не отмечать)
+app.config['SLOW_REQUEST_MS'] = int(os.environ.get('SLOW_REQUEST_MS', 1000))
+# Доля запросов под cProfile (0 — выключено); профили медленных сохраняются в PROFILE_FOLDER
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+app.config['PROFILE_FOLDER'] = os.environ.get('PROFILE_FOLDER', 'profiles')
+# Доля запросов, для которых пишется подробный отладочный лог
+app.config['LOG_SAMPLE_RATE'] = float(os.environ.get('LOG_SAMPLE_RATE', 0.01))
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+# MIME-типы, с которыми отдаются обложки и их уменьшенные копии
+COVER_MIME_TYPES = {'image/png', 'image/jpeg', 'image/gif', 'image/webp'}
 
-# Регистрация фильтра markdown
+# Регистрация фильтра markdown: сохранённый HTML, а для старых записей — рендер через кэш
 @app.template_filter('markdown')
-def markdown_filter(text):
-    return markdown.markdown(text)
+def markdown_filter(text, html=None):
+    return html if html is not None else cached_markdown(text)
+
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'])
 
 # Инициализация расширений
 db.init_app(app)
+db_engine = database.init_app(app, db)
+instrumentation = Instrumentation(
+    app, db_engine,
+    slow_request_ms=app.config['SLOW_REQUEST_MS'],
+    profile_sample_rate=app.config['PROFILE_SAMPLE_RATE'],
+    profile_folder=app.config['PROFILE_FOLDER'],
+)
+passwords.hasher.configure(app.config['PASSWORD_HASH_METHOD'], workers=app.config['PASSWORD_HASH_WORKERS'],
+                           max_pending=app.config['PASSWORD_HASH_QUEUE'])
+login_limiter = passwords.LoginLimiter(app.config['LOGIN_RATE_PER_IP'], app.config['LOGIN_RATE_PER_LOGIN'])
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+identity_cache = IdentityCache(ttl=app.config['IDENTITY_CACHE_TTL'])
+app.jinja_env.globals.update(Permission=Permission, can=can)
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return identity_cache.get(int(user_id))
 
 # Создание необходимых директорий
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['STATIC_COVERS_FOLDER'], exist_ok=True)
 
-# Функция для добавления тестовых книг
-def add_test_books():
-    print("Начинаем добавление тестовых книг...")
-    test_books = [
-        {
-            'title': 'Властелин колец',
-            'author': 'Джон Р. Р. Толкин',
-            'year': 1954,
-            'publisher': 'Allen & Unwin',
-            'pages': 1178,
-            'description': 'Эпическая фэнтезийная трилогия о борьбе за Кольцо Всевластия и противостоянии сил добра и зла.',
-            'genres': ['Фантастика', 'Приключения']
-        },
-        {
-            'title': '1984',
-            'author': 'Джордж Оруэлл',
-            'year': 1949,
-            'publisher': 'Secker & Warburg',
-            'pages': 328,
-            'description': 'Антиутопический роман о тоталитарном обществе, где правит Большой Брат.',
-            'genres': ['Фантастика', 'Психологический']
-        },
-        {
-            'title': 'Убить пересмешника',
-            'author': 'Харпер Ли',
-            'year': 1960,
-            'publisher': 'J. B. Lippincott & Co.',
-            'pages': 281,
-            'description': 'Роман о расовой несправедливости и потере невинности в американском Юге.',
-            'genres': ['Роман', 'Драма']
-        },
-        {
-            'title': 'Великий Гэтсби',
-            'author': 'Фрэнсис Скотт Фицджеральд',
-            'year': 1925,
-            'publisher': 'Charles Scribner\'s Sons',
-            'pages': 180,
-            'description': 'Роман о "американской мечте" и её крахе в эпоху "ревущих двадцатых".',
-            'genres': ['Роман', 'Драма']
-        },
-        {
-            'title': 'Алхимик',
-            'author': 'Пауло Коэльо',
-            'year': 1988,
-            'publisher': 'HarperTorch',
-            'pages': 208,
-            'description': 'Философская притча о поиске своего предназначения и сокровищах жизни.',
-            'genres': ['Роман', 'Приключения']
-        },
-        {
-            'title': 'Тень ветра',
-            'author': 'Карлос Руис Сафон',
-            'year': 2001,
-            'publisher': 'Planeta',
-            'pages': 544,
-            'description': 'Захватывающий роман о таинственной книге и её влиянии на судьбы людей.',
-            'genres': ['Роман', 'Детектив']
-        },
-        {
-            'title': 'Марсианин',
-            'author': 'Энди Вейер',
-            'year': 2011,
-            'publisher': 'Crown',
-            'pages': 369,
-            'description': 'Научно-фантастический роман о выживании астронавта на Марсе.',
-            'genres': ['Фантастика', 'Приключения']
-        },
-        {
-            'title': 'Сто лет одиночества',
-            'author': 'Габриэль Гарсиа Маркес',
-            'year': 1967,
-            'publisher': 'Editorial Sudamericana',
-            'pages': 417,
-            'description': 'Магический реализм в истории семьи Буэндиа на протяжении ста лет.',
-            'genres': ['Роман', 'Фантастика']
-        }
-    ]
-    
-    for book_data in test_books:
-        # Проверяем, существует ли уже книга с таким названием
-        if not Book.query.filter_by(title=book_data['title']).first():
-            print(f"Добавляем книгу: {book_data['title']}")
-            book = Book(
-                title=book_data['title'],
-                author=book_data['author'],
-                year=book_data['year'],
-                publisher=book_data['publisher'],
-                pages=book_data['pages'],
-                description=book_data['description']
-            )
-            
-            # Добавляем книгу в сессию перед добавлением жанров
-            db.session.add(book)
-            db.session.flush()  # Получаем ID книги
-            
-            # Добавляем жанры
-            for genre_name in book_data['genres']:
-                genre = Genre.query.filter_by(name=genre_name).first()
-                if genre:
-                    book.genres.append(genre)
-                    print(f"Добавлен жанр {genre_name} к книге {book_data['title']}")
-            
-            try:
-                db.session.commit()
-                print(f"Книга {book_data['title']} успешно добавлена")
-            except Exception as e:
-                print(f"Ошибка при добавлении книги {book_data['title']}: {str(e)}")
-                db.session.rollback()
-        else:
-            print(f"Книга {book_data['title']} уже существует")
-
-# Создание базы данных при первом запуске
-with app.app_context():
+# Индекс файлов обложек для get_cover()
+cover_index = cover_storage.CoverIndex(app.config['UPLOAD_FOLDER'], app.config['STATIC_COVERS_FOLDER'])
+thumbnail_cache = thumbnails.ThumbnailCache(app.config['THUMBNAIL_FOLDER'], app.config['THUMBNAIL_CACHE_MAX_BYTES'])
+page_cache = PageCache(
+    create_backend(app.config['PAGE_CACHE'], folder=app.config['PAGE_CACHE_FOLDER'], url=app.config['PAGE_CACHE_URL']),
+    ttl=app.config['PAGE_CACHE_TTL']
+)
+
+# Тестовые книги, которые добавляет `flask seed`
+TEST_BOOKS = [
+    {
+        'title': 'Властелин колец',
+        'author': 'Джон Р. Р. Толкин',
+        'year': 1954,
+        'publisher': 'Allen & Unwin',
+        'pages': 1178,
+        'description': 'Эпическая фэнтезийная трилогия о борьбе за Кольцо Всевластия и противостоянии сил добра и зла.',
+        'genres': ['Фантастика', 'Приключения']
+    },
+    {
+        'title': '1984',
+        'author': 'Джордж Оруэлл',
+        'year': 1949,
+        'publisher': 'Secker & Warburg',
+        'pages': 328,
+        'description': 'Антиутопический роман о тоталитарном обществе, где правит Большой Брат.',
+        'genres': ['Фантастика', 'Психологический']
+    },
+    {
+        'title': 'Убить пересмешника',
+        'author': 'Харпер Ли',
+        'year': 1960,
+        'publisher': 'J. B. Lippincott & Co.',
+        'pages': 281,
+        'description': 'Роман о расовой несправедливости и потере невинности в американском Юге.',
+        'genres': ['Роман', 'Драма']
+    },
+    {
+        'title': 'Великий Гэтсби',
+        'author': 'Фрэнсис Скотт Фицджеральд',
+        'year': 1925,
+        'publisher': 'Charles Scribner\'s Sons',
+        'pages': 180,
+        'description': 'Роман о "американской мечте" и её крахе в эпоху "ревущих двадцатых".',
+        'genres': ['Роман', 'Драма']
+    },
+    {
+        'title': 'Алхимик',
+        'author': 'Пауло Коэльо',
+        'year': 1988,
+        'publisher': 'HarperTorch',
+        'pages': 208,
+        'description': 'Философская притча о поиске своего предназначения и сокровищах жизни.',
+        'genres': ['Роман', 'Приключения']
+    },
+    {
+        'title': 'Тень ветра',
+        'author': 'Карлос Руис Сафон',
+        'year': 2001,
+        'publisher': 'Planeta',
+        'pages': 544,
+        'description': 'Захватывающий роман о таинственной книге и её влиянии на судьбы людей.',
+        'genres': ['Роман', 'Детектив']
+    },
+    {
+        'title': 'Марсианин',
+        'author': 'Энди Вейер',
+        'year': 2011,
+        'publisher': 'Crown',
+        'pages': 369,
+        'description': 'Научно-фантастический роман о выживании астронавта на Марсе.',
+        'genres': ['Фантастика', 'Приключения']
+    },
+    {
+        'title': 'Сто лет одиночества',
+        'author': 'Габриэль Гарсиа Маркес',
+        'year': 1967,
+        'publisher': 'Editorial Sudamericana',
+        'pages': 417,
+        'description': 'Магический реализм в истории семьи Буэндиа на протяжении ста лет.',
+        'genres': ['Роман', 'Фантастика']
+    }
+]
+
+ROLES = (
+    (ADMIN_ROLE, 'Суперпользователь, имеет полный доступ к системе'),
+    (MODERATOR_ROLE, 'Может редактировать данные книг и производить модерацию рецензий'),
+    (USER_ROLE, 'Может оставлять рецензии'),
+)
+
+GENRES = (
+    'Фантастика', 'Детектив', 'Роман', 'Поэзия', 'Драма',
+    'Комедия', 'Трагедия', 'Приключения', 'Исторический',
+    'Биография', 'Учебная литература', 'Детская литература',
+    'Психологический'
+)
+
+def init_database():
+    """Создаёт таблицы, применяет миграции и создаёт поисковый индекс"""
     db.create_all()
-    # Создаем роли, если их нет
-    if not Role.query.first():
-        print("Создаем роли...")
-        roles = [
-            Role(name='Администратор', description='Суперпользователь, имеет полный доступ к системе'),
-            Role(name='Модератор', description='Может редактировать данные книг и производить модерацию рецензий'),
-            Role(name='Пользователь', description='Может оставлять рецензии')
-        ]
-        db.session.add_all(roles)
+    migrations.upgrade(db.engine)
+    if search.init_search():
+        # Заполняем только что созданный поисковый индекс существующими книгами
+        with db.engine.begin() as connection:
+            search.reindex_books(connection)
+
+def seed_database(with_test_books=True):
+    """Добавляет недостающие роли, жанры, администратора и тестовые книги.
+
+    Повторный запуск ничего не дублирует. Возвращает счётчики импорта книг.
+    """
+    existing_roles = {name for name, in db.session.query(Role.name)}
+    new_roles = [{'name': name, 'description': description}
+                 for name, description in ROLES if name not in existing_roles]
+    if new_roles:
+        db.session.execute(db.insert(Role), new_roles)
+        roles.invalidate()
+    existing_genres = {name for name, in db.session.query(Genre.name)}
+    new_genres = [{'name': name} for name in GENRES if name not in existing_genres]
+    if new_genres:
+        db.session.execute(db.insert(Genre), new_genres)
+    if not db.session.query(User.query.filter_by(login='admin').exists()).scalar():
+        admin = User(login='admin', last_name='Админ', first_name='Админ', role_id=roles.admin)
+        admin.set_password('admin')
+        db.session.add(admin)
+    db.session.commit()
+    stats = importer.ImportStats()
+    if with_test_books:
+        genre_ids = dict(db.session.query(Genre.name, Genre.id))
+        importer.import_chunk([importer.parse_record(book) for book in TEST_BOOKS], genre_ids, stats)
         db.session.commit()
-        print("Роли созданы")
-        
-        # Создаем жанры, если их нет
-        if not Genre.query.first():
-            print("Создаем жанры...")
-            genres = [
-                'Фантастика', 'Детектив', 'Роман', 'Поэзия', 'Драма',
-                'Комедия', 'Трагедия', 'Приключения', 'Исторический',
-                'Биография', 'Учебная литература', 'Детская литература',
-                'Психологический'
-            ]
-            for genre_name in genres:
-                genre = Genre(name=genre_name)
-                db.session.add(genre)
-                print(f"Добавлен жанр: {genre_name}")
-            db.session.commit()
-            print("Жанры созданы")
-            
-            # Создаем администратора
-            print("Создаем администратора...")
-            admin = User(
-                login='admin',
-                last_name='Админ',
-                first_name='Админ',
-                role_id=1
-            )
-            admin.set_password('admin')
-            db.session.add(admin)
-            db.session.commit()
-            print("Администратор создан")
-            
-            # Добавляем тестовые книги
-            add_test_books()
+    return stats
 
 # Маршруты для аутентификации
 @app.route('/login', methods=['GET', 'POST'])
@@ -219,8 +299,23 @@ def login():
         password = request.form.get('password')
         remember = request.form.get('remember', False)
         
+        # Лимит проверяется до поиска пользователя и хеширования пароля
+        retry_after = login_limiter.allow(request.remote_addr, login)
+        if retry_after is not None:
+            flash('Слишком много попыток входа. Повторите попытку позже')
+            return render_template('login.html'), 429, {'Retry-After': str(retry_after)}
+        
         user = User.query.filter_by(login=login).first()
-        if user and user.check_password(password):
+        try:
+            valid = user is not None and user.check_password(password)
+            if valid and passwords.hasher.needs_rehash(user.password_hash):
+                # Политика хеширования изменилась: пересчитываем хеш, пока известен пароль
+                user.set_password(password)
+                db.session.commit()
+        except passwords.HasherBusy:
+            flash('Сервер перегружен. Повторите попытку входа позже')
+            return render_template('login.html'), 503, {'Retry-After': '1'}
+        if valid:
             login_user(user, remember=remember)
             next_page = request.args.get('next')
             return redirect(next_page or url_for('index'))
@@ -236,39 +331,88 @@ def logout():
 
 # Главная страница
 @app.route('/')
+@page_cache.page
 def index():
-    page = request.args.get('page', 1, type=int)
-    books = Book.query.order_by(Book.year.desc()).paginate(page=page, per_page=10)
-    print(f"Найдено книг: {books.total}")
-    for book in books.items:
-        print(f"Книга: {book.title}, Автор: {book.author}, Год: {book.year}")
-        # Рассчитываем средний рейтинг
-        reviews = Review.query.filter_by(book_id=book.id).all()
-        if reviews:
-            book.avg_rating = sum(review.rating for review in reviews) / len(reviews)
-        else:
-            book.avg_rating = 0
-    return render_template('index.html', books=books)
+    catalog_filter = CatalogFilter.from_args(request.args)
+    facets = facet_counts(catalog_filter, app.config['FACET_CACHE_TTL'])
+    cursor = request.args.get('cursor')
+    keyset = bool(cursor) or app.config['CATALOG_PAGINATION'] == 'keyset'
+    position = cursor if keyset else request.args.get('page', 1, type=int)
+    catalog = page_cache.fragment(
+        ('catalog', current_role(), keyset, position, catalog_filter.key),
+        lambda: render_catalog(catalog_filter, keyset, position)
+    )
+    return render_template('index.html', catalog_html=catalog['html'], book_ids=catalog['book_ids'],
+                           catalog_filter=catalog_filter, facets=facets)
+
+def render_catalog(catalog_filter, keyset, position):
+    """Сетка книг каталога с навигацией по страницам и id показанных книг"""
+    if keyset:
+        books = book_page(position, catalog_filter=catalog_filter)
+    else:
+        books = (catalog_filter.apply(Book.query.options(*queries.BOOK_LIST))
+                 .order_by(Book.year.desc(), Book.id.desc())
+                 .paginate(page=position, per_page=BOOKS_PER_PAGE, count=False))
+        books.total = catalog_count(app.config['CATALOG_COUNT'], app.config['CATALOG_COUNT_TTL'],
+                                    catalog_filter=catalog_filter)
+    if logger.isEnabledFor(logging.DEBUG) and sample(app.config['LOG_SAMPLE_RATE']):
+        logger.debug(f"Каталог: найдено книг {getattr(books, 'total', None)}, на странице: "
+                     + ', '.join(f"{book.title} ({book.author}, {book.year})" for book in books.items))
+    html = render_template('catalog_grid.html', books=books, keyset=keyset, catalog_filter=catalog_filter)
+    return {'html': html, 'book_ids': [book.id for book in books.items]}
+
+@app.route('/search')
+def search_view():
+    query = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    books, has_next = search.search_books(query, page=page)
+    return render_template('search.html', query=query, books=books, page=page, has_next=has_next)
 
 # Маршруты для работы с книгами
 @app.route('/book/<int:book_id>')
+@page_cache.page
 def book_detail(book_id):
-    book = Book.query.get_or_404(book_id)
-    return render_template('book_detail.html', book=book)
+    book = Book.query.options(*queries.BOOK_DETAIL).filter_by(id=book_id).first_or_404()
+    user_review = None
+    if current_user.is_authenticated:
+        user_review = Review.query.filter_by(book_id=book_id, user_id=current_user.id).first()
+    reviews = review_page(book_id, exclude_user_id=user_review.user_id if user_review else None)
+    return render_template('book_detail.html', book=book, user_review=user_review, reviews=reviews)
+
+@app.route('/book/<int:book_id>/reviews')
+def book_reviews(book_id):
+    """Следующая страница рецензий книги в формате JSON"""
+    if not db.session.query(Book.query.filter_by(id=book_id).exists()).scalar():
+        return jsonify({'error': 'Книга не найдена'}), 404
+    exclude_user_id = current_user.id if current_user.is_authenticated else None
+    reviews = review_page(book_id, cursor=request.args.get('cursor'), exclude_user_id=exclude_user_id)
+    return jsonify({
+        'reviews': [{
+            'id': review.id,
+            'author': f"{review.user.last_name} {review.user.first_name}",
+            'rating': review.rating,
+            'created_at': review.created_at.strftime('%d.%m.%Y %H:%M'),
+            'html': markdown_filter(review.text, review.text_html)
+        } for review in reviews.items],
+        'next_cursor': reviews.next_cursor
+    })
 
 @app.route('/book/new', methods=['GET', 'POST'])
 @login_required
+@permission_required(Permission.CREATE_BOOKS)
 def book_new():
-    if current_user.role.name != 'Администратор':
-        flash('У вас недостаточно прав для выполнения данного действия')
-        return redirect(url_for('index'))
-    
     if request.method == 'POST':
+        if not cover_upload_allowed():
+            flash('Недопустимый формат файла')
+            return render_template('book_form.html', genres=Genre.query.all())
+        stored_hash = None
         try:
             # Создание книги
+            description = bleach.clean(request.form['description'])
             book = Book(
                 title=request.form['title'],
-                description=bleach.clean(request.form['description']),
+                description=description,
+                description_html=render_markdown(description),
                 year=request.form['year'],
                 publisher=request.form['publisher'],
                 author=request.form['author'],
@@ -288,27 +432,7 @@ def book_new():
             if 'cover' in request.files:
                 file = request.files['cover']
                 if file.filename:
-                    filename = secure_filename(file.filename)
-                    file_content = file.read()
-                    md5_hash = hashlib.md5(file_content).hexdigest()
-                    
-                    # Проверка на дубликат
-                    existing_cover = Cover.query.filter_by(md5_hash=md5_hash).first()
-                    if existing_cover:
-                        book.cover = existing_cover
-                    else:
-                        cover = Cover(
-                            filename=filename,
-                            mime_type=file.content_type,
-                            md5_hash=md5_hash,
-                            book_id=book.id
-                        )
-                        db.session.add(cover)
-                        
-                        # Сохранение файла
-                        file_path = os.path.join(app.config['UPLOAD_FOLDER'], str(cover.id))
-                        with open(file_path, 'wb') as f:
-                            f.write(file_content)
+                    stored_hash = store_cover(book, file)
             
             db.session.commit()
             flash('Книга успешно добавлена')
@@ -316,6 +440,7 @@ def book_new():
             
         except Exception as e:
             db.session.rollback()
+            release_cover(stored_hash)
             flash('При сохранении данных возникла ошибка. Проверьте корректность введённых данных.')
             return render_template('book_form.html', book=book)
     
@@ -324,17 +449,19 @@ def book_new():
 
 @app.route('/book/<int:book_id>/edit', methods=['GET', 'POST'])
 @login_required
+@permission_required(Permission.EDIT_BOOKS)
 def book_edit(book_id):
-    if current_user.role.name != 'Администратор':
-        flash('У вас недостаточно прав для выполнения данного действия')
-        return redirect(url_for('index'))
-    
     book = Book.query.get_or_404(book_id)
     
     if request.method == 'POST':
+        if not cover_upload_allowed():
+            flash('Недопустимый формат файла')
+            return render_template('book_form.html', book=book, genres=Genre.query.all())
+        stored_hash = None
         try:
             book.title = request.form['title']
             book.description = bleach.clean(request.form['description'])
+            book.description_html = render_markdown(book.description)
             book.year = request.form['year']
             book.publisher = request.form['publisher']
             book.author = request.form['author']
@@ -352,28 +479,7 @@ def book_edit(book_id):
             if 'cover' in request.files:
                 file = request.files['cover']
                 if file.filename:
-                    filename = secure_filename(file.filename)
-                    file_content = file.read()
-                    
-                    # Удаляем старую обложку, если она есть
-                    if book.cover:
-                        old_cover_path = os.path.join(app.config['UPLOAD_FOLDER'], book.cover.filename)
-                        if os.path.exists(old_cover_path):
-                            os.remove(old_cover_path)
-                        db.session.delete(book.cover)
-                    
-                    cover = Cover(
-                        filename=filename,
-                        mime_type=file.content_type,
-                        md5_hash=filename,  # Используем имя файла как хеш
-                        book_id=book.id
-                    )
-                    db.session.add(cover)
-                    
-                    # Сохранение файла
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    with open(file_path, 'wb') as f:
-                        f.write(file_content)
+                    stored_hash = store_cover(book, file)
             
             db.session.commit()
             flash('Книга успешно обновлена')
@@ -381,6 +487,7 @@ def book_edit(book_id):
             
         except Exception as e:
             db.session.rollback()
+            release_cover(stored_hash)
             flash('При сохранении данных возникла ошибка. Проверьте корректность введённых данных.')
     
     genres = Genre.query.all()
@@ -388,20 +495,14 @@ def book_edit(book_id):
 
 @app.route('/book/<int:book_id>/delete', methods=['POST'])
 @login_required
+@permission_required(Permission.DELETE_BOOKS)
 def book_delete(book_id):
-    if current_user.role.name != 'Администратор':
-        flash('У вас недостаточно прав для выполнения данного действия')
-        return redirect(url_for('index'))
-    
     book = Book.query.get_or_404(book_id)
     
     try:
-        # Удаляем обложку, если она есть
+        # Файл обложки удаляется после commit, только если на него не ссылаются другие книги
         if book.cover:
-            cover_path = os.path.join(app.config['UPLOAD_FOLDER'], book.cover.md5_hash)
-            if os.path.exists(cover_path):
-                os.remove(cover_path)
-        
+            enqueue_task('cover.release', md5_hash=book.cover.md5_hash)
         db.session.delete(book)
         db.session.commit()
         flash('Книга успешно удалена')
@@ -414,6 +515,7 @@ def book_delete(book_id):
 # Маршруты для работы с рецензиями
 @app.route('/book/<int:book_id>/review', methods=['GET', 'POST'])
 @login_required
+@permission_required(Permission.WRITE_REVIEWS, 'book_detail', pass_args=('book_id',))
 def review_new(book_id):
     book = Book.query.get_or_404(book_id)
     
@@ -436,42 +538,62 @@ def review_new(book_id):
                 flash('Некорректная оценка')
                 return render_template('review_form.html', book=book)
             
+            text = bleach.clean(text)
             review = Review(
                 book_id=book_id,
                 user_id=current_user.id,
                 rating=rating,
-                text=bleach.clean(text)
+                text=text,
+                text_html=render_markdown(text)
             )
             db.session.add(review)
             db.session.commit()
             flash('Рецензия успешно добавлена')
             return redirect(url_for('book_detail', book_id=book_id))
         except Exception as e:
-            print(f"Ошибка при сохранении рецензии: {str(e)}")
+            logger.exception(f"Ошибка при сохранении рецензии: {str(e)}")
             db.session.rollback()
             flash('При сохранении рецензии возникла ошибка')
             return render_template('review_form.html', book=book)
     
     return render_template('review_form.html', book=book)
 
+# Выгрузка данных
+@app.route('/export/<dataset>')
+@login_required
+@permission_required(Permission.EXPORT_DATA)
+def export_data(dataset):
+    """Потоковая выгрузка набора; ?format=jsonl|csv, ?after_id=, ?since= (ISO-дата)"""
+    if dataset not in export.DATASETS:
+        return jsonify({'error': 'Неизвестный набор данных'}), 404
+    fmt = request.args.get('format', 'jsonl')
+    if fmt not in export.FORMATS:
+        return jsonify({'error': 'Неизвестный формат выгрузки'}), 400
+    try:
+        since = request.args.get('since')
+        records = export.iter_records(dataset, after_id=request.args.get('after_id', type=int),
+                                      since=datetime.fromisoformat(since) if since else None)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return Response(
+        stream_with_context(export.render(dataset, fmt, records)),
+        mimetype=export.FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename={dataset}.{fmt}'}
+    )
+
 # Маршруты для работы с подборками
 @app.route('/collections')
 @login_required
+@permission_required(Permission.MANAGE_COLLECTIONS)
 def collections():
-    if current_user.role.name != 'Пользователь':
-        flash('У вас недостаточно прав для выполнения данного действия')
-        return redirect(url_for('index'))
-    
     collections = Collection.query.filter_by(user_id=current_user.id).order_by(Collection.created_at.desc()).all()
-    return render_template('collections.html', collections=collections)
+    book_counts = collection_books.book_counts([collection.id for collection in collections])
+    return render_template('collections.html', collections=collections, book_counts=book_counts)
 
 @app.route('/collection/new', methods=['POST'])
 @login_required
+@permission_required(Permission.MANAGE_COLLECTIONS)
 def collection_new():
-    if current_user.role.name != 'Пользователь':
-        flash('У вас недостаточно прав для выполнения данного действия')
-        return redirect(url_for('index'))
-    
     name = request.form.get('name', '').strip()
     if not name:
         flash('Название подборки не может быть пустым')
@@ -487,67 +609,87 @@ def collection_new():
 @app.route('/collection/<int:collection_id>')
 @login_required
 def collection_detail(collection_id):
-    collection = Collection.query.get_or_404(collection_id)
+    collection = Collection.query.options(*queries.COLLECTION_DETAIL).filter_by(id=collection_id).first_or_404()
     
     if collection.user_id != current_user.id:
         flash('У вас нет доступа к этой подборке')
         return redirect(url_for('collections'))
     
-    # Рассчитываем средний рейтинг для каждой книги
-    for book in collection.books:
-        reviews = Review.query.filter_by(book_id=book.id).all()
-        if reviews:
-            book.avg_rating = sum(review.rating for review in reviews) / len(reviews)
-        else:
-            book.avg_rating = 0
-    
     return render_template('collection_detail.html', collection=collection)
 
 @app.route('/book/<int:book_id>/add-to-collection', methods=['POST'])
 @login_required
+@permission_required(Permission.MANAGE_COLLECTIONS, 'book_detail', pass_args=('book_id',))
 def add_to_collection(book_id):
-    if current_user.role.name != 'Пользователь':
-        flash('У вас недостаточно прав для выполнения данного действия')
-        return redirect(url_for('book_detail', book_id=book_id))
-    
-    collection_id = request.form.get('collection_id')
+    collection_id = request.form.get('collection_id', type=int)
     if not collection_id:
         flash('Не выбрана подборка')
         return redirect(url_for('book_detail', book_id=book_id))
     
-    book = Book.query.get_or_404(book_id)
-    collection = Collection.query.get_or_404(collection_id)
+    owner_id = collection_owner_or_404(collection_id)
+    if not db.session.query(Book.query.filter_by(id=book_id).exists()).scalar():
+        abort(404)
     
-    if collection.user_id != current_user.id:
+    if owner_id != current_user.id:
         flash('У вас нет доступа к этой подборке')
         return redirect(url_for('book_detail', book_id=book_id))
     
-    if book not in collection.books:
-        collection.books.append(book)
+    if collection_books.contains(collection_id, book_id):
+        flash('Книга уже есть в этой подборке')
+    else:
+        # Параллельное добавление той же книги пропускается ON CONFLICT DO NOTHING
+        collection_books.add_books(collection_id, [book_id])
         db.session.commit()
         flash('Книга успешно добавлена в подборку')
-    else:
-        flash('Книга уже есть в этой подборке')
     
     return redirect(url_for('book_detail', book_id=book_id))
 
 @app.route('/collection/<int:collection_id>/book/<int:book_id>/remove', methods=['POST'])
 @login_required
 def remove_from_collection(collection_id, book_id):
-    collection = Collection.query.get_or_404(collection_id)
-    
-    if collection.user_id != current_user.id:
+    if collection_owner_or_404(collection_id) != current_user.id:
         flash('У вас нет доступа к этой подборке')
         return redirect(url_for('collections'))
     
-    book = Book.query.get_or_404(book_id)
-    if book in collection.books:
-        collection.books.remove(book)
+    if collection_books.remove_books(collection_id, [book_id]):
         db.session.commit()
         flash('Книга успешно удалена из подборки')
     
     return redirect(url_for('collection_detail', collection_id=collection_id))
 
+@app.route('/collection/<int:collection_id>/books', methods=['POST'])
+@login_required
+@permission_required(Permission.MANAGE_COLLECTIONS)
+def collection_books_batch(collection_id):
+    """Пакетное изменение подборки: JSON {"add": [id книг], "remove": [id книг]}"""
+    owner_id = db.session.query(Collection.user_id).filter_by(id=collection_id).scalar()
+    if owner_id is None:
+        return jsonify({'error': 'Подборка не найдена'}), 404
+    if owner_id != current_user.id:
+        return jsonify({'error': 'У вас нет доступа к этой подборке'}), 403
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Ожидается JSON-объект с полями add и remove'}), 400
+    changes = {}
+    for field in ('add', 'remove'):
+        book_ids = data.get(field, [])
+        if (not isinstance(book_ids, list) or len(book_ids) > collection_books.MAX_BATCH
+                or not all(isinstance(book_id, int) and not isinstance(book_id, bool) for book_id in book_ids)):
+            return jsonify({'error': f"{field}: список не более {collection_books.MAX_BATCH} id книг"}), 400
+        changes[field] = book_ids
+    added = collection_books.add_books(collection_id, changes['add'])
+    removed = collection_books.remove_books(collection_id, changes['remove'])
+    db.session.commit()
+    count = collection_books.book_counts([collection_id]).get(collection_id, 0)
+    return jsonify({'added': added, 'removed': removed, 'count': count})
+
+def collection_owner_or_404(collection_id):
+    """id владельца подборки без загрузки самой подборки"""
+    owner_id = db.session.query(Collection.user_id).filter_by(id=collection_id).scalar()
+    if owner_id is None:
+        abort(404)
+    return owner_id
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
@@ -562,7 +704,7 @@ def register():
                 login=request.form['login'],
                 last_name=request.form['last_name'],
                 first_name=request.form['first_name'],
-                role_id=3  # Роль "Пользователь"
+                role_id=roles.user
             )
             user.set_password(request.form['password'])
             
@@ -572,6 +714,10 @@ def register():
             flash('Регистрация успешна! Теперь вы можете войти.')
             return redirect(url_for('login'))
             
+        except passwords.HasherBusy:
+            db.session.rollback()
+            flash('Сервер перегружен. Повторите попытку регистрации позже')
+            return render_template('register.html'), 503
         except Exception as e:
             db.session.rollback()
             flash('При регистрации возникла ошибка')
@@ -582,21 +728,89 @@ def register():
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def get_file_hash(file):
-    """Вычисляет MD5 хеш файла"""
-    md5_hash = hashlib.md5()
-    for chunk in iter(lambda: file.read(4096), b""):
-        md5_hash.update(chunk)
-    file.seek(0)  # Сбрасываем указатель файла в начало
-    return md5_hash.hexdigest()
+def cover_upload_allowed():
+    """Допустимо ли расширение обложки, приложенной к форме книги (если она есть)"""
+    file = request.files.get('cover')
+    return not (file and file.filename) or allowed_file(file.filename)
+
+def cover_mime_type(filename):
+    """MIME-тип обложки по расширению; тип, присланный браузером, не используется"""
+    return mimetypes.guess_type('cover.' + filename.rsplit('.', 1)[1].lower())[0]
+
+def release_cover(md5_hash):
+    """Удаляет файл обложки без ссылок из хранилища и из индекса"""
+    if cover_storage.release(app.config['UPLOAD_FOLDER'], md5_hash):
+        cover_index.discard_blob(md5_hash)
+
+def store_cover(book, file):
+    """Сохраняет загруженную обложку в хранилище и назначает её книге.
+
+    Расширение файла должно быть проверено allowed_file(). До проверки
+    изображения обложка отдаётся с типом по расширению, после — с типом,
+    определённым Pillow. Проверка, подготовка уменьшенных копий и
+    освобождение файла заменённой обложки выполняются фоновыми задачами
+    после commit. Возвращает хеш новой обложки.
+    """
+    mime_type = cover_mime_type(file.filename)
+    md5_hash = cover_storage.save_upload(file, app.config['UPLOAD_FOLDER'])
+    cover_index.add_blob(md5_hash, mime_type)
+    if book.cover:
+        enqueue_task('cover.release', md5_hash=book.cover.md5_hash)
+    book.cover = Cover(
+        filename=secure_filename(file.filename),
+        mime_type=mime_type,
+        md5_hash=md5_hash,
+        status='pending'
+    )
+    db.session.flush()
+    enqueue_task('cover.process', cover_id=book.cover.id)
+    return md5_hash
+
+def enqueue_task(kind, **payload):
+    """Ставит фоновую задачу в очередь в текущей транзакции"""
+    if app.config['TASK_MODE'] == 'thread':
+        tasks.start_threads(app, app.config['TASK_WORKER_THREADS'])
+    return tasks.enqueue(kind, **payload)
+
+@tasks.handler('cover.process')
+def process_cover(cover_id):
+    """Проверяет загруженную обложку и заранее готовит её уменьшенные копии"""
+    cover = db.session.get(Cover, cover_id)
+    if cover is None or cover.status != 'pending':
+        return
+    path = cover_storage.blob_path(app.config['UPLOAD_FOLDER'], cover.md5_hash)
+    mime_type = thumbnails.inspect_image(path)
+    if mime_type not in COVER_MIME_TYPES:
+        logger.warning(f"Обложка {cover.id} не является изображением допустимого формата")
+        cover.status = 'failed'
+        db.session.commit()
+        # Файл с тем же хешем у других обложек тоже не изображение
+        cover_index.discard_blob(cover.md5_hash)
+        return
+    formats = ('webp', 'jpeg') if thumbnails.webp_supported() else ('jpeg',)
+    for preset in thumbnails.PRESETS:
+        for fmt in formats:
+            thumbnail_cache.get(path, cover.md5_hash, preset, fmt)
+    cover.mime_type = mime_type
+    cover.status = 'ready'
+    db.session.commit()
+    cover_index.add_blob(cover.md5_hash, mime_type)
+
+@tasks.handler('cover.release')
+def release_cover_task(md5_hash):
+    """Удаляет файл заменённой или удалённой обложки, если он больше не нужен"""
+    release_cover(md5_hash)
+
+@tasks.handler('cover.gc')
+def collect_cover_garbage():
+    """Удаляет все файлы хранилища, на которые не ссылается ни одна обложка"""
+    for md5_hash in cover_storage.collect_garbage(app.config['UPLOAD_FOLDER']):
+        cover_index.discard_blob(md5_hash)
 
 @app.route('/book/<int:book_id>/cover', methods=['POST'])
 @login_required
+@permission_required(Permission.UPLOAD_COVERS, 'book_detail', pass_args=('book_id',))
 def upload_cover(book_id):
-    if current_user.role.name != 'Администратор':
-        flash('У вас недостаточно прав для выполнения данного действия')
-        return redirect(url_for('book_detail', book_id=book_id))
-    
     book = Book.query.get_or_404(book_id)
     
     if 'cover' not in request.files:
@@ -609,28 +823,7 @@ def upload_cover(book_id):
         return redirect(url_for('book_detail', book_id=book_id))
     
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        mime_type = file.content_type
-        
-        # Удаляем старую обложку, если она есть
-        if book.cover:
-            old_cover_path = os.path.join(app.config['UPLOAD_FOLDER'], book.cover.filename)
-            if os.path.exists(old_cover_path):
-                os.remove(old_cover_path)
-            db.session.delete(book.cover)
-        
-        # Сохраняем файл с оригинальным именем
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
-        
-        # Создаем запись в базе данных
-        cover = Cover(
-            filename=filename,
-            mime_type=mime_type,
-            md5_hash=filename,  # Используем имя файла как хеш
-            book_id=book.id
-        )
-        db.session.add(cover)
+        store_cover(book, file)
         db.session.commit()
         
         flash('Обложка успешно добавлена')
@@ -642,39 +835,68 @@ def upload_cover(book_id):
 @app.route('/covers/<filename>')
 def get_cover(filename):
     """Маршрут для получения обложки"""
-    logger.info(f"Запрос обложки: {filename}")
-    
     # Декодируем имя файла из URL
     filename = filename.replace('_', ' ')  # Заменяем подчеркивания на пробелы
-    logger.info(f"Декодированное имя файла: {filename}")
-    
-    # Сначала ищем в директории пользовательских загрузок
-    upload_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    logger.info(f"Проверяем путь: {upload_path}")
-    if os.path.exists(upload_path):
-        logger.info(f"Обложка найдена в {upload_path}")
-        return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
-    
-    # Если не нашли, ищем в директории статических файлов
-    static_path = os.path.join(app.config['STATIC_COVERS_FOLDER'], filename)
-    logger.info(f"Проверяем путь: {static_path}")
-    if os.path.exists(static_path):
-        logger.info(f"Обложка найдена в {static_path}")
-        return send_from_directory(app.config['STATIC_COVERS_FOLDER'], filename)
-    
-    # Если файл не найден, пробуем найти его без учета регистра и с разными вариантами подчеркиваний
-    for root, dirs, files in os.walk(app.config['STATIC_COVERS_FOLDER']):
-        for file in files:
-            logger.info(f"Сравниваем с файлом: {file}")
-            # Нормализуем имена файлов для сравнения
-            normalized_request = filename.lower().replace('__', '_').replace('_', '')
-            normalized_file = file.lower().replace('__', '_').replace('_', '')
-            if normalized_file == normalized_request:
-                logger.info(f"Обложка найдена (после нормализации): {file}")
-                return send_from_directory(root, file)
-    
-    logger.error(f"Обложка не найдена: {filename}")
-    return "Обложка не найдена", 404
+    
+    # Поиск по индексу: хеш содержимого, загрузки, статические обложки
+    # и, наконец, нормализованное имя без учета регистра и подчеркиваний
+    cover_file = cover_index.lookup(filename)
+    if cover_file is None:
+        logger.debug(f"Обложка не найдена: {filename}")
+        return "Обложка не найдена", 404
+    
+    # Адрес по хешу содержимого (или с совпадающей версией ?v=) никогда не меняет содержимое
+    immutable = cover_storage.is_content_hash(filename) or request.args.get('v') == cover_file.etag
+    
+    # Уменьшенная копия для списков: ?size=thumb|medium
+    size = request.args.get('size')
+    if size in thumbnails.PRESETS:
+        fmt = 'webp' if 'image/webp' in request.headers.get('Accept', '') and thumbnails.webp_supported() else 'jpeg'
+        path = thumbnail_cache.get(cover_file.path, cover_file.etag, size, fmt)
+        if path is not None:
+            cover_file = cover_storage.CoverFile(
+                path, thumbnails.FORMATS[fmt][1], f'{cover_file.etag}-{size}-{fmt}', cover_file.mtime
+            )
+            response = cover_response(cover_file, immutable)
+            response.vary.add('Accept')
+            return response
+    return cover_response(cover_file, immutable)
+
+def cover_response(cover_file, immutable):
+    """Ответ с файлом обложки с заголовками кэширования и поддержкой 304"""
+    mime_type = cover_file.mime_type or mimetypes.guess_type(cover_file.path)[0]
+    if mime_type not in COVER_MIME_TYPES:
+        mime_type = 'application/octet-stream'
+    if app.config['COVER_SENDFILE'] == 'x-accel':
+        # Файл отдаёт nginx из internal-location, отображённого на каталог приложения
+        response = app.response_class(mimetype=mime_type)
+        relative_path = os.path.relpath(os.path.abspath(cover_file.path)).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = app.config['COVER_ACCEL_PREFIX'].rstrip('/') + '/' + quote(relative_path)
+    else:
+        # При COVER_SENDFILE=x-sendfile send_file сам ставит заголовок X-Sendfile
+        response = send_file(os.path.abspath(cover_file.path), mimetype=mime_type, etag=False, conditional=False)
+    response.set_etag(cover_file.etag)
+    response.last_modified = cover_file.mtime
+    # Браузер не должен угадывать тип по содержимому (HTML или скрипт под видом картинки)
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = COVER_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = None
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.template_global('cover_url')
+def cover_url(cover, size=None):
+    """URL обложки (или её уменьшенной копии), меняющийся вместе с содержимым"""
+    if cover_storage.is_content_hash(cover.md5_hash):
+        return url_for('get_cover', filename=cover.md5_hash, size=size)
+    # Старые обложки адресуются именем файла, версия добавляется параметром
+    cover_file = cover_index.lookup(cover.md5_hash.replace('_', ' '))
+    return url_for('get_cover', filename=cover.md5_hash, v=cover_file.etag if cover_file else None, size=size)
 
 @app.errorhandler(500)
 def internal_error(error):
@@ -705,6 +927,17 @@ def test_db():
             'message': str(e)
         }, 500
 
+@app.route('/metrics')
+def metrics():
+    """Метрики процесса в текстовом формате Prometheus"""
+    return Response(instrumentation.render(database.pool_samples(db.engine)),
+                    mimetype='text/plain; version=0.0.4')
+
+@app.route('/metrics/db')
+def db_metrics():
+    """Состояние пула соединений текущего процесса"""
+    return database.pool_status(db.engine)
+
 @app.route('/test-cover/<int:book_id>')
 def test_cover(book_id):
     """Маршрут для проверки информации об обложке"""
@@ -826,7 +1059,176 @@ def cleanup_books():
         return {'message': 'Книги удалены', 'removed': removed}
     return {'message': 'Нет книг для удаления'}
 
+@app.cli.command('init-db')
+def init_db_command():
+    """Создаёт таблицы, применяет миграции и создаёт поисковый индекс"""
+    try:
+        init_database()
+    except migrations.MigrationError as e:
+        raise click.ClickException(str(e))
+    click.echo("База данных готова")
+
+@app.cli.command('migrate')
+@click.option('--list', 'list_only', is_flag=True, help='Только показать миграции и их состояние')
+def migrate_command(list_only):
+    """Применяет неприменённые миграции схемы"""
+    if list_only:
+        applied = migrations.applied_versions(db.engine)
+        for version, description, _ in migrations.MIGRATIONS:
+            click.echo(f"{version} {'+' if version in applied else ' '} {description}")
+        return
+    try:
+        done = migrations.upgrade(db.engine, log=click.echo)
+    except migrations.MigrationError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Применено миграций: {len(done)}")
+
+@app.cli.command('seed')
+@click.option('--no-test-books', is_flag=True, help='Не добавлять тестовые книги')
+def seed_command(no_test_books):
+    """Добавляет роли, жанры, администратора и тестовые книги"""
+    stats = seed_database(with_test_books=not no_test_books)
+    if stats.inserted:
+        page_cache.invalidate()
+    click.echo(f"Начальные данные добавлены, новых книг: {stats.inserted}")
+
+@app.cli.command('rebuild-ratings')
+@click.option('--verify', is_flag=True, help='Только проверить агрегаты, ничего не изменяя')
+def rebuild_ratings(verify):
+    """Пересчитывает review_count и rating_sum книг по таблице рецензий"""
+    migrations.upgrade(db.engine)
+    actual = {
+        book_id: (count, rating_sum)
+        for book_id, count, rating_sum in db.session.query(
+            Review.book_id, func.count(Review.id), func.coalesce(func.sum(Review.rating), 0)
+        ).group_by(Review.book_id)
+    }
+    mismatched = 0
+    for book_id, review_count, rating_sum in db.session.query(Book.id, Book.review_count, Book.rating_sum):
+        expected = actual.get(book_id, (0, 0))
+        if (review_count, rating_sum) == expected:
+            continue
+        mismatched += 1
+        click.echo(f"Книга {book_id}: сохранено {(review_count, rating_sum)}, фактически {expected}")
+        if not verify:
+            db.session.query(Book).filter_by(id=book_id).update(
+                {'review_count': expected[0], 'rating_sum': expected[1]},
+                synchronize_session=False
+            )
+    if verify:
+        click.echo(f"Расхождений: {mismatched}")
+        if mismatched:
+            raise SystemExit(1)
+        return
+    db.session.commit()
+    click.echo(f"Исправлено книг: {mismatched}")
+
+@app.cli.command('gc-covers')
+@click.option('--dry-run', is_flag=True, help='Только показать файлы без ссылок')
+def gc_covers(dry_run):
+    """Удаляет из хранилища файлы обложек, на которые не ссылается ни одна книга"""
+    removed = cover_storage.collect_garbage(app.config['UPLOAD_FOLDER'], dry_run=dry_run)
+    for md5_hash in removed:
+        click.echo(md5_hash)
+    click.echo(f"{'Найдено' if dry_run else 'Удалено'} файлов без ссылок: {len(removed)}")
+
+@app.cli.command('reindex-search')
+def reindex_search():
+    """Перестраивает полнотекстовый индекс каталога"""
+    search.init_search()
+    with db.engine.begin() as connection:
+        search.reindex_books(connection)
+    click.echo("Поисковый индекс перестроен")
+
+@app.cli.command('render-markdown')
+@click.option('--all', 'render_all', is_flag=True, help='Перерендерить все записи, а не только без HTML')
+@click.option('--batch-size', default=500, show_default=True, help='Число записей в одной транзакции')
+def render_markdown_command(render_all, batch_size):
+    """Заполняет сохранённый HTML описаний книг и текстов рецензий"""
+    migrations.upgrade(db.engine)
+    for model, source, target in ((Book, Book.description, 'description_html'),
+                                  (Review, Review.text, 'text_html')):
+        query = db.session.query(model.id, source).order_by(model.id)
+        if not render_all:
+            query = query.filter(getattr(model, target).is_(None))
+        last_id, total = 0, 0
+        while True:
+            rows = query.filter(model.id > last_id).limit(batch_size).all()
+            if not rows:
+                break
+            db.session.execute(db.update(model), [
+                {'id': row_id, target: render_markdown(value)} for row_id, value in rows
+            ])
+            db.session.commit()
+            last_id, total = rows[-1][0], total + len(rows)
+        click.echo(f"{model.__tablename__}: обработано записей {total}")
+
+@app.cli.command('import-books')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Формат файла; по умолчанию — по расширению')
+@click.option('--chunk-size', default=1000, show_default=True, help='Число строк в одной транзакции')
+@click.option('--skip-html', is_flag=True, help='Не вычислять HTML описаний (заполнить позже командой render-markdown)')
+def import_books_command(path, fmt, chunk_size, skip_html):
+    """Импортирует книги из CSV или JSONL; уже существующие книги пропускаются"""
+    fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+    report = lambda stats: click.echo(
+        f"Прочитано: {stats.read}, добавлено: {stats.inserted}, "
+        f"уже были: {stats.existing}, с ошибками: {stats.invalid}, {stats.rate:.0f} строк/с"
+    )
+    with open(path, encoding='utf-8-sig', newline='') as file:
+        stats = importer.import_books(file, fmt, chunk_size=chunk_size, progress=report,
+                                      render_html=not skip_html)
+    if stats.inserted:
+        page_cache.invalidate()
+    click.echo(f"Импорт завершён. Новых жанров: {stats.genres_created}")
+
+@app.cli.command('export')
+@click.argument('dataset', type=click.Choice(sorted(export.DATASETS)))
+@click.option('--format', 'fmt', type=click.Choice(sorted(export.FORMATS)), default='jsonl', show_default=True)
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8'), default='-', help='Файл (по умолчанию stdout)')
+@click.option('--after-id', type=int, help='Выгрузить только записи с id больше указанного')
+@click.option('--since', type=click.DateTime(), help='Выгрузить только записи, созданные начиная с этого момента')
+@click.option('--batch-size', default=export.BATCH_SIZE, show_default=True, help='Размер порции чтения')
+def export_command(dataset, fmt, output, after_id, since, batch_size):
+    """Выгружает книги, рецензии или подборки в JSONL или CSV"""
+    try:
+        records = export.iter_records(dataset, after_id=after_id, since=since, batch_size=batch_size)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    watermark = {'count': 0, 'last_id': after_id}
+
+    def tracked(records):
+        for record in records:
+            watermark['count'] += 1
+            watermark['last_id'] = record['id']
+            yield record
+
+    for chunk in export.render(dataset, fmt, tracked(records)):
+        output.write(chunk)
+    # Последний id — значение --after-id для следующей инкрементальной выгрузки
+    click.echo(f"Выгружено записей: {watermark['count']}, последний id: {watermark['last_id']}", err=True)
+
+@app.cli.command('worker')
+@click.option('--threads', default=1, show_default=True, help='Число потоков-обработчиков')
+@click.option('--once', is_flag=True, help='Выполнить накопившиеся задачи и завершиться')
+def worker(threads, once):
+    """Обрабатывает очередь фоновых задач"""
+    if once:
+        click.echo(f"Выполнено задач: {tasks.run_pending()}")
+        return
+    tasks.start_threads(app, threads - 1)
+    tasks.work(app)
+
+@app.cli.command('enqueue-cover-gc')
+def enqueue_cover_gc():
+    """Ставит в очередь удаление файлов обложек без ссылок"""
+    enqueue_task('cover.gc')
+    db.session.commit()
+    click.echo("Задача поставлена в очередь")
+
 if __name__ == '__main__':
+    # Для локальной разработки; при развёртывании выполняются `flask init-db` и `flask seed`
     with app.app_context():
-        db.create_all()
+        init_database()
+        seed_database()
     app.run(debug=True) 
\ No newline at end of file
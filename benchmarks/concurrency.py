@@ -0,0 +1,168 @@
+"""Ёмкость воркера gunicorn по одновременным медленным соединениям.
+
+Для каждого типа воркера запускается gunicorn с одним воркером. К нему
+открывается K медленных клиентов: каждый, как при загрузке обложки по
+медленному каналу, передаёт тело POST-запроса мелкими порциями в течение
+--slow-seconds. Одновременно замеряется время быстрых запросов. Ёмкость
+воркера — наибольшее K, при котором все быстрые запросы уложились в
+--max-ms.
+
+    python benchmarks/concurrency.py
+    python benchmarks/concurrency.py --worker-class sync --worker-class gthread --levels 1,4,16
+
+Тип gevent пропускается, если пакет gevent не установлен.
+"""
+import argparse
+import http.client
+import importlib.util
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('DATABASE_URL', 'sqlite:///benchmark.db')
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+WORKER_CLASSES = ('sync', 'gthread', 'gevent')
+SLOW_CHUNKS = 20
+PROBES = 5
+
+
+def start_gunicorn(args, worker_class):
+    command = [sys.executable, '-m', 'gunicorn', '--workers', '1', '--worker-class', worker_class,
+               '--bind', f'{args.host}:{args.port}', '--timeout', str(int(args.slow_seconds * 10)), '--backlog', '2048']
+    # Явное --threads: иначе gunicorn.conf.py превратит sync в gthread
+    command += ['--threads', str(args.threads if worker_class == 'gthread' else 1)]
+    if worker_class == 'gevent':
+        command += ['--worker-connections', str(args.worker_connections)]
+    process = subprocess.Popen(command + ['app:app'], cwd=ROOT,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"gunicorn ({worker_class}) завершился с кодом {process.returncode}")
+        try:
+            probe(args.host, args.port, 5)
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit(f"gunicorn ({worker_class}) не ответил за 60 с")
+
+
+def probe(host, port, timeout):
+    """Быстрый запрос; возвращает время ответа в секундах"""
+    started = time.perf_counter()
+    connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        connection.request('GET', '/login')
+        connection.getresponse().read()
+    finally:
+        connection.close()
+    return time.perf_counter() - started
+
+
+def slow_client(host, port, body_size, seconds):
+    """POST /login, тело которого передаётся порциями в течение seconds"""
+    body = ('login=slow&pad=' + 'x' * body_size).encode()
+    chunk = len(body) // SLOW_CHUNKS + 1
+    try:
+        with socket.create_connection((host, port), timeout=seconds * 10) as connection:
+            connection.sendall((
+                "POST /login HTTP/1.1\r\nHost: localhost\r\n"
+                "Content-Type: application/x-www-form-urlencoded\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+            ).encode())
+            for start in range(0, len(body), chunk):
+                connection.sendall(body[start:start + chunk])
+                time.sleep(seconds / SLOW_CHUNKS)
+            while connection.recv(65536):
+                pass
+    except OSError:
+        pass
+
+
+def measure_level(args, level):
+    """Время быстрых запросов при level медленных соединениях"""
+    clients = [threading.Thread(target=slow_client, args=(args.host, args.port, args.body_size, args.slow_seconds))
+               for _ in range(level)]
+    for client in clients:
+        client.start()
+    # Медленные клиенты успевают подключиться и начать передачу
+    time.sleep(min(0.5, args.slow_seconds / 4))
+    timings = []
+    for _ in range(PROBES):
+        try:
+            timings.append(probe(args.host, args.port, args.slow_seconds * 3) * 1000)
+        except OSError:
+            timings.append(float('inf'))
+        time.sleep(args.slow_seconds / (2 * PROBES))
+    for client in clients:
+        client.join()
+    return timings
+
+
+def run_worker_class(args, worker_class):
+    process = start_gunicorn(args, worker_class)
+    levels = {}
+    capacity = 0
+    try:
+        for level in args.levels:
+            timings = measure_level(args, level)
+            levels[level] = {'median_ms': round(statistics.median(timings), 1), 'max_ms': round(max(timings), 1)}
+            print(f"{worker_class:>8} K={level:<4} быстрые запросы: медиана {levels[level]['median_ms']:>8} мс, "
+                  f"макс {levels[level]['max_ms']:>8} мс")
+            if max(timings) > args.max_ms:
+                break
+            capacity = level
+    finally:
+        process.terminate()
+        process.wait()
+    return {'capacity': capacity, 'levels': levels}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--worker-class', action='append', choices=WORKER_CLASSES,
+                        help='Тип воркера (можно указать несколько раз); по умолчанию все')
+    parser.add_argument('--levels', default='1,2,4,8,16,32,64',
+                        type=lambda value: [int(level) for level in value.split(',')],
+                        help='Числа медленных соединений через запятую')
+    parser.add_argument('--threads', type=int, default=8, help='Потоков воркера gthread')
+    parser.add_argument('--worker-connections', type=int, default=100, help='Соединений воркера gevent')
+    parser.add_argument('--slow-seconds', type=float, default=3.0, help='Длительность медленной загрузки, с')
+    parser.add_argument('--body-size', type=int, default=256 * 1024, help='Размер тела медленного запроса, байт')
+    parser.add_argument('--max-ms', type=float, default=500.0, help='Допустимое время быстрого запроса, мс')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--output', help='Записать результаты в JSON')
+    args = parser.parse_args()
+
+    from app import app, init_database
+    with app.app_context():
+        init_database()
+
+    results = {}
+    for worker_class in args.worker_class or WORKER_CLASSES:
+        if worker_class == 'gevent' and importlib.util.find_spec('gevent') is None:
+            print("gevent не установлен, пропускаем")
+            continue
+        results[worker_class] = run_worker_class(args, worker_class)
+
+    print("\nЁмкость одного воркера (медленных соединений без задержки быстрых запросов):")
+    for worker_class, result in results.items():
+        print(f"{worker_class:>8}: {result['capacity']}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,536 @@
+"""Нагрузочный бенчмарк основных маршрутов.
+
+Сначала в отдельную базу загружается синтетический набор данных, затем
+маршруты index, book_detail, collection_detail, get_cover, review_new и
+login прогоняются через тестовый клиент Flask (в процессе, с подсчётом
+SQL-запросов) или через запущенный gunicorn с несколькими воркерами (SQL-
+запросы считаются по гистограмме app_request_sql_queries из /metrics
+каждого воркера до и после замера).
+
+    python benchmarks/load.py seed --books 100000 --reviews 1000000 --users 10000
+    python benchmarks/load.py run --requests 500
+    python benchmarks/load.py run --server gunicorn --workers 4 --concurrency 16
+    python benchmarks/load.py run --save-baseline benchmarks/baseline.json
+    python benchmarks/load.py run --baseline benchmarks/baseline.json --max-regression 20
+
+База задаётся DATABASE_URL (по умолчанию SQLite instance/benchmark.db),
+остальные настройки приложения — обычными переменными окружения. С
+--baseline скрипт завершается с кодом 1, если p95 какого-либо маршрута
+выросла больше чем на --max-regression процентов. review_new добавляет
+рецензии, поэтому базу бенчмарка не стоит использовать для чего-то ещё.
+Ограничение попыток входа на время бенчмарка выключено (LOGIN_RATE_PER_*).
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('DATABASE_URL', 'sqlite:///benchmark.db')
+# Все клиенты бенчмарка входят с одного адреса
+os.environ.setdefault('LOGIN_RATE_PER_IP', '0')
+os.environ.setdefault('LOGIN_RATE_PER_LOGIN', '0')
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+PASSWORD = 'benchmark'
+LOGIN_PREFIX = 'bench'
+SCENARIOS = ('index', 'book_detail', 'collection_detail', 'get_cover', 'review_new', 'login')
+WORDS = ('книга', 'роман', 'герой', 'история', 'время', 'город', 'дорога', 'письмо', 'память',
+         'война', 'мир', 'море', 'дом', 'семья', 'тайна', 'путь', 'сон', 'свет', 'ночь', 'друг')
+BATCH_SIZE = 5000
+SQL_METRIC_RE = re.compile(r'^app_request_sql_queries_(sum|count)\{endpoint="([^"]*)"\} (\S+)$')
+
+
+def _text(rng, words):
+    sentence = ' '.join(rng.choice(WORDS) for _ in range(words))
+    return f"**{sentence[:20]}** {sentence}. _{rng.choice(WORDS)}_"
+
+
+def _batches(rows, size=BATCH_SIZE):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+# Синтетический набор данных
+
+def seed(args):
+    from sqlalchemy import insert, update
+    from app import app, db, init_database, seed_database
+    from models import User, Book, Genre, Cover, Review, Collection, book_collection
+    from identity import roles
+    from rendering import render_markdown
+    import cover_storage
+    import importer
+    import passwords
+
+    rng = random.Random(args.seed)
+    with app.app_context():
+        init_database()
+        seed_database(with_test_books=False)
+        if db.session.query(User.id).filter(User.login.startswith(LOGIN_PREFIX)).first():
+            print("Набор данных уже загружен; для новой загрузки удалите базу бенчмарка")
+            return 1
+        started = time.perf_counter()
+
+        # Пользователи: один хеш пароля на всех, иначе загрузка упрётся в хеширование
+        password_hash = passwords.hasher.hash(PASSWORD)
+        user_table = User.__table__
+        user_ids = []
+        for batch in _batches([{'login': f'{LOGIN_PREFIX}{number}', 'password_hash': password_hash,
+                                'last_name': 'Тестов', 'first_name': f'Читатель {number}',
+                                'role_id': roles.user} for number in range(args.users)]):
+            user_ids += db.session.execute(
+                insert(user_table).returning(user_table.c.id, sort_by_parameter_order=True), batch
+            ).scalars().all()
+        db.session.commit()
+        print(f"Пользователей: {len(user_ids)}")
+
+        # Книги — через импортёр: жанры, HTML описаний и поисковый индекс
+        genre_names = [name for name, in db.session.query(Genre.name)]
+        genre_ids = dict(db.session.query(Genre.name, Genre.id))
+        stats = importer.ImportStats()
+        book_ids = []
+        for start in range(0, args.books, 1000):
+            records = [{
+                'title': f"Книга {number}",
+                'author': f"Автор {number % 5000}",
+                'year': rng.randint(1900, 2024),
+                'publisher': f"Издательство {number % 200}",
+                'pages': rng.randint(50, 1200),
+                'description': _text(rng, 40),
+                'genres': rng.sample(genre_names, rng.randint(1, 2)),
+            } for number in range(start, min(start + 1000, args.books))]
+            book_ids += importer.import_chunk(records, genre_ids, stats, render_html=not args.skip_html)
+            db.session.commit()
+        print(f"Книг: {len(book_ids)}")
+
+        # Рецензии: у пользователя не больше одной на книгу
+        texts = [_text(rng, 25) for _ in range(50)]
+        rendered = {text: render_markdown(text) for text in texts}
+        now = datetime.utcnow()
+        aggregates = {}
+        review_rows = []
+        per_user, extra = divmod(args.reviews, max(len(user_ids), 1))
+        for index, user_id in enumerate(user_ids):
+            count = min(per_user + (1 if index < extra else 0), len(book_ids))
+            for book_id in rng.sample(book_ids, count):
+                rating = rng.randint(0, 5)
+                text = rng.choice(texts)
+                review_rows.append({'book_id': book_id, 'user_id': user_id, 'rating': rating, 'text': text,
+                                    'text_html': rendered[text],
+                                    'created_at': now - timedelta(minutes=rng.randint(0, 3 * 365 * 24 * 60))})
+                count_sum = aggregates.setdefault(book_id, [0, 0])
+                count_sum[0] += 1
+                count_sum[1] += rating
+            if len(review_rows) >= BATCH_SIZE:
+                db.session.execute(insert(Review.__table__), review_rows)
+                review_rows = []
+        if review_rows:
+            db.session.execute(insert(Review.__table__), review_rows)
+        # Массовая вставка идёт мимо событий, пересчитывающих агрегаты рейтинга
+        for batch in _batches([{'id': book_id, 'review_count': count, 'rating_sum': rating_sum}
+                               for book_id, (count, rating_sum) in aggregates.items()]):
+            db.session.execute(update(Book), batch)
+        db.session.commit()
+        print(f"Рецензий: {sum(count for count, _ in aggregates.values())}")
+
+        # Подборки
+        collection_table = Collection.__table__
+        collection_rows = [{'name': f"Подборка {number}", 'user_id': user_id, 'created_at': now}
+                           for user_id in user_ids for number in range(args.collections_per_user)]
+        links = []
+        for batch in _batches(collection_rows):
+            for collection_id in db.session.execute(
+                insert(collection_table).returning(collection_table.c.id, sort_by_parameter_order=True), batch
+            ).scalars():
+                links += [{'collection_id': collection_id, 'book_id': book_id}
+                          for book_id in rng.sample(book_ids, min(args.books_per_collection, len(book_ids)))]
+        for batch in _batches(links):
+            db.session.execute(insert(book_collection), batch)
+        db.session.commit()
+        print(f"Подборок: {len(collection_rows)}")
+
+        # Обложки: разные однотонные JPEG для первых книг
+        from PIL import Image
+        cover_rows = []
+        for book_id in book_ids[:args.covers]:
+            buffer = io.BytesIO()
+            Image.new('RGB', (400, 600), tuple(rng.randrange(256) for _ in range(3))).save(buffer, 'JPEG')
+            buffer.seek(0)
+            md5_hash = cover_storage.save_upload(buffer, app.config['UPLOAD_FOLDER'])
+            cover_rows.append({'filename': f'cover-{book_id}.jpg', 'mime_type': 'image/jpeg',
+                               'md5_hash': md5_hash, 'book_id': book_id, 'status': 'ready'})
+        if cover_rows:
+            db.session.execute(insert(Cover.__table__), cover_rows)
+        db.session.commit()
+        print(f"Обложек: {len(cover_rows)}")
+        print(f"Готово за {time.perf_counter() - started:.1f} с")
+    return 0
+
+
+# Прогон маршрутов
+
+class Targets:
+    """Адреса для запросов, выбранные из базы бенчмарка"""
+
+    def __init__(self, max_page, sessions):
+        from sqlalchemy import func
+        from app import app, db
+        from models import User, Book, Cover, Collection
+        from pagination import BOOKS_PER_PAGE
+
+        with app.app_context():
+            self.book_ids = [book_id for book_id, in db.session.query(Book.id)]
+            pages = (len(self.book_ids) + BOOKS_PER_PAGE - 1) // BOOKS_PER_PAGE
+            self.max_page = max(1, min(max_page, pages))
+            self.covers = [md5_hash for md5_hash, in db.session.query(Cover.md5_hash).filter(Cover.status == 'ready')]
+            users = (db.session.query(User.id, User.login)
+                     .filter(User.login.startswith(LOGIN_PREFIX))
+                     .order_by(func.random()).limit(sessions).all())
+            collections = {}
+            for collection_id, user_id in (db.session.query(Collection.id, Collection.user_id)
+                                           .filter(Collection.user_id.in_([user_id for user_id, _ in users]))):
+                collections.setdefault(user_id, []).append(collection_id)
+            self.users = [(login, collections.get(user_id, [])) for user_id, login in users]
+        if not self.book_ids or not self.users:
+            raise SystemExit("База бенчмарка пуста: сначала выполните `python benchmarks/load.py seed`")
+        self.urls = app.url_map.bind('localhost')
+
+    def endpoint(self, method, path):
+        """Endpoint маршрута, который обработает запрос"""
+        return self.urls.match(path.split('?', 1)[0], method=method)[0]
+
+    def request(self, scenario, rng, user):
+        """(метод, путь, данные формы, нужен ли вход) для одного запроса сценария"""
+        login, collection_ids = user
+        if scenario == 'index':
+            return 'GET', f'/?page={rng.randint(1, self.max_page)}', None, False
+        if scenario == 'book_detail':
+            return 'GET', f'/book/{rng.choice(self.book_ids)}', None, False
+        if scenario == 'collection_detail':
+            if not collection_ids:
+                return 'GET', '/collections', None, True
+            return 'GET', f'/collection/{rng.choice(collection_ids)}', None, True
+        if scenario == 'get_cover':
+            if not self.covers:
+                return 'GET', '/login', None, False
+            return 'GET', f'/covers/{rng.choice(self.covers)}?size=thumb', None, False
+        if scenario == 'review_new':
+            data = {'rating': rng.randint(0, 5), 'text': _text(rng, 20)}
+            return 'POST', f'/book/{rng.choice(self.book_ids)}/review', data, True
+        return 'POST', '/login', {'login': login, 'password': PASSWORD}, False
+
+
+class ClientDriver:
+    """Запросы через тестовый клиент Flask в текущем процессе"""
+
+    name = 'client'
+
+    def __init__(self):
+        from sqlalchemy import event
+        from app import app, db
+
+        self.app = app
+        self.queries = 0
+        with app.app_context():
+            event.listen(db.engine, 'after_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.queries += 1
+
+    def query_totals(self):
+        return None
+
+    def session(self, login=None):
+        client = self.app.test_client()
+        if login:
+            response = client.post('/login', data={'login': login, 'password': PASSWORD})
+            if response.status_code != 302:
+                raise SystemExit(f"Не удалось войти как {login}")
+        return client
+
+    def request(self, client, method, path, data):
+        queries = self.queries
+        started = time.perf_counter()
+        response = client.open(path, method=method, data=data)
+        response.get_data()
+        response.close()
+        return response.status_code, time.perf_counter() - started, self.queries - queries
+
+
+class HttpSession:
+    """Соединение keep-alive с сохранением cookie"""
+
+    def __init__(self, host, port):
+        self.connection = http.client.HTTPConnection(host, port, timeout=60)
+        self.cookies = {}
+
+    def request(self, method, path, data):
+        headers = {'Accept': 'text/html,image/webp'}
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{name}={value}' for name, value in self.cookies.items())
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        response.read()
+        for header in response.headers.get_all('Set-Cookie') or ():
+            name, _, value = header.split(';', 1)[0].partition('=')
+            self.cookies[name.strip()] = value
+        return response.status
+
+
+class HttpDriver:
+    """Запросы по HTTP к запущенному серверу (gunicorn)"""
+
+    name = 'gunicorn'
+
+    def __init__(self, host, port, workers):
+        self.host = host
+        self.port = port
+        self.workers = workers
+
+    def query_totals(self):
+        """{(pid воркера, endpoint): [сумма SQL-запросов, число запросов]} по /metrics всех воркеров.
+
+        Каждое новое соединение попадает к случайному воркеру, поэтому
+        метрики запрашиваются, пока не ответят все; None — если не удалось.
+        """
+        totals, seen = {}, set()
+        for _ in range(self.workers * 50):
+            connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            try:
+                connection.request('GET', '/metrics')
+                text = connection.getresponse().read().decode()
+            finally:
+                connection.close()
+            pid, values = None, {}
+            for line in text.splitlines():
+                if line.startswith('app_process_id '):
+                    pid = int(line.split()[1])
+                match = SQL_METRIC_RE.match(line)
+                if match:
+                    kind, endpoint, value = match.groups()
+                    values.setdefault(endpoint, [0, 0])[kind == 'count'] = float(value)
+            if pid not in seen:
+                seen.add(pid)
+                totals.update(((pid, endpoint), value) for endpoint, value in values.items())
+            if len(seen) == self.workers:
+                return totals
+        return None
+
+    def session(self, login=None):
+        session = HttpSession(self.host, self.port)
+        if login and session.request('POST', '/login', {'login': login, 'password': PASSWORD}) != 302:
+            raise SystemExit(f"Не удалось войти как {login}")
+        return session
+
+    def request(self, session, method, path, data):
+        started = time.perf_counter()
+        status = session.request(method, path, data)
+        return status, time.perf_counter() - started, None
+
+
+def start_gunicorn(args):
+    """Запускает gunicorn с приложением и ждёт, пока он начнёт отвечать"""
+    command = [sys.executable, '-m', 'gunicorn', '--workers', str(args.workers),
+               '--bind', f'{args.host}:{args.port}', *args.gunicorn_arg, 'app:app']
+    process = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"gunicorn завершился с кодом {process.returncode}")
+        try:
+            connection = http.client.HTTPConnection(args.host, args.port, timeout=5)
+            connection.request('GET', '/login')
+            connection.getresponse().read()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("gunicorn не ответил за 60 с")
+
+
+def percentile(values, fraction):
+    """Перцентиль по ближайшему рангу для отсортированного списка"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, round(fraction * len(values) + 0.5) - 1))]
+
+
+def run_scenario(driver, targets, scenario, requests, concurrency, warmup, seed):
+    """Выполняет сценарий в concurrency потоках; возвращает сводку"""
+    endpoints = set()
+
+    def worker(number, count, record):
+        rng = random.Random(f'{seed}-{scenario}-{number}')
+        user = targets.users[number % len(targets.users)]
+        _, _, _, needs_login = targets.request(scenario, rng, user)
+        session = driver.session(user[0] if needs_login else None)
+        results = []
+        for _ in range(count):
+            method, path, data, _ = targets.request(scenario, rng, user)
+            endpoints.add(targets.endpoint(method, path))
+            if scenario == 'login':
+                session = driver.session()
+            results.append(driver.request(session, method, path, data))
+        return results if record else []
+
+    shares = [requests // concurrency + (1 if number < requests % concurrency else 0)
+              for number in range(concurrency)]
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(lambda number: worker(number, warmup, False), range(concurrency)))
+        before = driver.query_totals()
+        started = time.perf_counter()
+        results = [result for part in executor.map(lambda number: worker(number, shares[number], True),
+                                                   range(concurrency)) for result in part]
+        elapsed = time.perf_counter() - started
+        after = driver.query_totals()
+
+    latencies = sorted(seconds * 1000 for _, seconds, _ in results)
+    queries = [count for _, _, count in results if count is not None]
+    queries_per_request = round(sum(queries) / len(queries), 2) if queries else None
+    if before is not None and after is not None:
+        # Прирост гистограмм воркеров по endpoint сценария; вход сессий идёт в login и не учитывается
+        total = count = 0
+        for key, (after_sum, after_count) in after.items():
+            if key[1] in endpoints:
+                before_sum, before_count = before.get(key, (0, 0))
+                total += after_sum - before_sum
+                count += after_count - before_count
+        queries_per_request = round(total / count, 2) if count else None
+    return {
+        'requests': len(results),
+        'errors': sum(1 for status, _, _ in results if status >= 400),
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'rps': round(len(results) / elapsed, 1) if elapsed else 0.0,
+        'queries_per_request': queries_per_request,
+    }
+
+
+def compare(results, baseline, max_regression):
+    """Печатает изменения относительно базовых результатов; возвращает число регрессий"""
+    regressions = 0
+    print(f"\nСравнение с базовым прогоном ({baseline['meta'].get('created', '?')}):")
+    for scenario, current in results['scenarios'].items():
+        previous = baseline['scenarios'].get(scenario)
+        if not previous:
+            continue
+        changes = []
+        for key in ('p50_ms', 'p95_ms', 'p99_ms', 'rps'):
+            if previous[key]:
+                changes.append(f"{key} {(current[key] - previous[key]) / previous[key] * 100:+.1f}%")
+        p95_growth = (current['p95_ms'] - previous['p95_ms']) / previous['p95_ms'] * 100 if previous['p95_ms'] else 0
+        regression = max_regression is not None and p95_growth > max_regression
+        regressions += regression
+        print(f"{scenario:>18}: {', '.join(changes)}{'  РЕГРЕССИЯ' if regression else ''}")
+    return regressions
+
+
+def run(args):
+    scenarios = args.scenario or list(SCENARIOS)
+    concurrency = args.concurrency if args.server == 'gunicorn' else 1
+    targets = Targets(args.max_page, max(concurrency, 1))
+    process = None
+    if args.server == 'gunicorn':
+        process = start_gunicorn(args)
+        driver = HttpDriver(args.host, args.port, args.workers)
+    else:
+        driver = ClientDriver()
+    try:
+        summary = {}
+        for scenario in scenarios:
+            summary[scenario] = run_scenario(driver, targets, scenario, args.requests, concurrency,
+                                             args.warmup, args.seed)
+            result = summary[scenario]
+            queries = '-' if result['queries_per_request'] is None else f"{result['queries_per_request']:.1f}"
+            print(f"{scenario:>18}: p50 {result['p50_ms']:8.2f} мс, p95 {result['p95_ms']:8.2f} мс, "
+                  f"p99 {result['p99_ms']:8.2f} мс, {result['rps']:8.1f} з/с, SQL/запрос {queries}, "
+                  f"ошибок {result['errors']}")
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    results = {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'server': driver.name,
+            'workers': args.workers if process is not None else None,
+            'concurrency': concurrency,
+            'gunicorn_args': args.gunicorn_arg if process is not None else [],
+            'requests': args.requests,
+            'books': len(targets.book_ids),
+            'python': platform.python_version(),
+        },
+        'scenarios': summary,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+        print(f"Базовые результаты сохранены в {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = json.load(file)
+        if compare(results, baseline, args.max_regression):
+            return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = commands.add_parser('seed', help='Загрузить синтетический набор данных')
+    seed_parser.add_argument('--books', type=int, default=10000)
+    seed_parser.add_argument('--reviews', type=int, default=100000)
+    seed_parser.add_argument('--users', type=int, default=1000)
+    seed_parser.add_argument('--collections-per-user', type=int, default=2)
+    seed_parser.add_argument('--books-per-collection', type=int, default=10)
+    seed_parser.add_argument('--covers', type=int, default=100)
+    seed_parser.add_argument('--skip-html', action='store_true', help='Не вычислять HTML описаний книг')
+    seed_parser.add_argument('--seed', type=int, default=1)
+
+    run_parser = commands.add_parser('run', help='Прогнать маршруты и вывести задержки')
+    run_parser.add_argument('--server', choices=('client', 'gunicorn'), default='client')
+    run_parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                            help='Сценарий (можно указать несколько раз); по умолчанию все')
+    run_parser.add_argument('--requests', type=int, default=200, help='Запросов на сценарий')
+    run_parser.add_argument('--warmup', type=int, default=10, help='Запросов на поток до замера')
+    run_parser.add_argument('--concurrency', type=int, default=8, help='Параллельных клиентов (gunicorn)')
+    run_parser.add_argument('--workers', type=int, default=4, help='Воркеров gunicorn')
+    run_parser.add_argument('--gunicorn-arg', action='append', default=[],
+                            help='Дополнительный аргумент gunicorn, например --gunicorn-arg=--threads=4')
+    run_parser.add_argument('--host', default='127.0.0.1')
+    run_parser.add_argument('--port', type=int, default=8765)
+    run_parser.add_argument('--max-page', type=int, default=100, help='Наибольший номер страницы каталога')
+    run_parser.add_argument('--output', help='Записать результаты в JSON')
+    run_parser.add_argument('--save-baseline', help='Сохранить результаты как базовые')
+    run_parser.add_argument('--baseline', help='Сравнить с базовыми результатами')
+    run_parser.add_argument('--max-regression', type=float, help='Допустимый рост p95, %%')
+    run_parser.add_argument('--seed', type=int, default=1)
+
+    args = parser.parse_args()
+    return seed(args) if args.command == 'seed' else run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
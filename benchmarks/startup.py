@@ -0,0 +1,60 @@
+"""Замер времени запуска приложения.
+
+Каждый прогон — новый интерпретатор, как при холодном старте или
+перезапуске воркера gunicorn: измеряются импорт app.py и первый запрос.
+
+    python benchmarks/startup.py --runs 10 --max-ms 1500
+
+С --max-ms скрипт завершается с кодом 1, если медиана полного времени
+запуска превышает бюджет.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.app.test_client().get('/login')
+print(json.dumps({'import': imported - start, 'first_request': time.perf_counter() - imported}))
+"""
+
+
+def run_once():
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', CHILD], cwd=ROOT, check=True,
+                            capture_output=True, text=True).stdout
+    total = time.perf_counter() - started
+    result = json.loads(output.strip().splitlines()[-1])
+    result['total'] = total
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-ms', type=float, help='Бюджет медианы полного времени запуска, мс')
+    args = parser.parse_args()
+
+    results = [run_once() for _ in range(args.runs)]
+    for name in ('import', 'first_request', 'total'):
+        values = [result[name] * 1000 for result in results]
+        print(f"{name:>14}: медиана {statistics.median(values):7.1f} мс, "
+              f"мин {min(values):7.1f} мс, макс {max(values):7.1f} мс")
+    median_total = statistics.median(result['total'] for result in results) * 1000
+    if args.max_ms is not None and median_total > args.max_ms:
+        print(f"Медиана {median_total:.1f} мс превышает бюджет {args.max_ms:.1f} мс")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,73 @@
+"""Состав подборок: запросы напрямую к таблице связи book_collection.
+
+Проверка, добавление и удаление книг не загружают список книг подборки
+(Collection.books): принадлежность проверяется EXISTS по первичному ключу,
+добавление — одним INSERT ... SELECT, пропускающим несуществующие книги
+и уже добавленные (ON CONFLICT DO NOTHING на PostgreSQL и SQLite),
+удаление — одним DELETE. Число книг подборок считается одним GROUP BY
+по индексу ix_book_collection_collection.
+
+Операции не фиксируют транзакцию; после них загруженные ранее
+Collection.books могут быть устаревшими.
+"""
+from sqlalchemy import delete, exists, func, insert, literal, select
+from models import db, Book, book_collection
+
+# Наибольшее число книг в одной пакетной операции
+MAX_BATCH = 1000
+
+
+def contains(collection_id, book_id):
+    """Есть ли книга в подборке"""
+    return db.session.query(exists().where(
+        book_collection.c.collection_id == collection_id,
+        book_collection.c.book_id == book_id,
+    )).scalar()
+
+
+def _insert_ignore():
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        return None
+    return dialect_insert(book_collection)
+
+
+def add_books(collection_id, book_ids):
+    """Добавляет книги в подборку; возвращает число добавленных"""
+    book_ids = set(book_ids)
+    if not book_ids:
+        return 0
+    books = select(Book.id, literal(collection_id)).where(Book.id.in_(book_ids))
+    statement = _insert_ignore()
+    if statement is not None:
+        statement = statement.from_select(['book_id', 'collection_id'], books).on_conflict_do_nothing()
+    else:
+        statement = insert(book_collection).from_select(['book_id', 'collection_id'], books.where(~exists().where(
+            book_collection.c.collection_id == collection_id,
+            book_collection.c.book_id == Book.id,
+        )))
+    return db.session.execute(statement).rowcount
+
+
+def remove_books(collection_id, book_ids):
+    """Удаляет книги из подборки; возвращает число удалённых"""
+    book_ids = set(book_ids)
+    if not book_ids:
+        return 0
+    return db.session.execute(delete(book_collection).where(
+        book_collection.c.collection_id == collection_id,
+        book_collection.c.book_id.in_(book_ids),
+    )).rowcount
+
+
+def book_counts(collection_ids):
+    """Число книг в каждой из подборок: {id подборки: число}"""
+    if not collection_ids:
+        return {}
+    return dict(db.session.query(book_collection.c.collection_id, func.count())
+                .filter(book_collection.c.collection_id.in_(collection_ids))
+                .group_by(book_collection.c.collection_id))
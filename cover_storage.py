@@ -0,0 +1,288 @@
+"""Контентно-адресуемое хранилище файлов обложек.
+
+Файл обложки хранится один раз под именем своего MD5-хеша в
+двухуровневых подкаталогах: <root>/ab/cd/abcd....  Несколько записей Cover
+(например, одна и та же картинка у разных книг) ссылаются на один файл
+через одинаковый md5_hash; файл удаляется только когда на него не
+осталось ни одной ссылки.
+
+Файл записывается (или переиспользуется) до фиксации записи Cover,
+которая на него ссылается, поэтому файлы, изменённые менее GRACE_PERIOD
+секунд назад, не удаляются, даже если ссылок на них ещё нет. При
+переиспользовании время изменения файла обновляется.
+"""
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from models import db, Cover
+
+CHUNK_SIZE = 64 * 1024
+# Время, за которое загрузка должна зафиксировать ссылающуюся на файл обложку
+GRACE_PERIOD = 15 * 60
+
+# Найденный файл обложки: путь, MIME-тип (None — определить по имени),
+# хеш содержимого для ETag и время изменения для Last-Modified
+CoverFile = namedtuple('CoverFile', 'path mime_type etag mtime')
+
+_HASH_RE = re.compile(r'[0-9a-f]{32}')
+
+
+def is_content_hash(value):
+    return bool(value) and _HASH_RE.fullmatch(value) is not None
+
+
+def blob_path(root, md5_hash):
+    """Путь к файлу с указанным хешем внутри хранилища"""
+    return os.path.join(root, md5_hash[:2], md5_hash[2:4], md5_hash)
+
+
+def save_upload(file, root):
+    """Потоково сохраняет загруженный файл в хранилище и возвращает его хеш.
+
+    Файл пишется во временный файл в том же каталоге с одновременным
+    подсчётом хеша, а затем атомарно переименовывается. Если такой файл
+    уже есть, временная копия удаляется, а у файла обновляется время
+    изменения, чтобы его не удалили до фиксации новой ссылки.
+    """
+    os.makedirs(root, exist_ok=True)
+    md5 = hashlib.md5()
+    stream = getattr(file, 'stream', file)
+    handle, temp_path = tempfile.mkstemp(dir=root, prefix='.upload-')
+    try:
+        with os.fdopen(handle, 'wb') as temp_file:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                md5.update(chunk)
+                temp_file.write(chunk)
+        md5_hash = md5.hexdigest()
+        path = blob_path(root, md5_hash)
+        if os.path.exists(path):
+            os.remove(temp_path)
+            os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return md5_hash
+
+
+def file_md5(path):
+    """Потоково вычисляет MD5 содержимого файла"""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def reference_count(md5_hash):
+    """Число записей Cover, ссылающихся на файл"""
+    return Cover.query.filter_by(md5_hash=md5_hash).count()
+
+
+def _recent(path, grace_period):
+    """Изменялся ли файл менее grace_period секунд назад (или уже удалён)"""
+    try:
+        return time.time() - os.stat(path).st_mtime < grace_period
+    except FileNotFoundError:
+        return True
+
+
+def release(root, md5_hash, grace_period=GRACE_PERIOD):
+    """Удаляет файл, если на него больше не ссылается ни одна обложка.
+
+    Вызывается после фиксации транзакции, удалившей или заменившей обложку.
+    Недавно записанный файл остаётся до следующей сборки мусора.
+    """
+    if not is_content_hash(md5_hash) or reference_count(md5_hash):
+        return False
+    path = blob_path(root, md5_hash)
+    if _recent(path, grace_period):
+        return False
+    os.remove(path)
+    return True
+
+
+def iter_blobs(root):
+    """Перебирает (хеш, путь) всех файлов хранилища"""
+    for shard in sorted(os.listdir(root)) if os.path.isdir(root) else ():
+        shard_path = os.path.join(root, shard)
+        if len(shard) != 2 or not os.path.isdir(shard_path):
+            continue
+        for subshard in sorted(os.listdir(shard_path)):
+            subshard_path = os.path.join(shard_path, subshard)
+            if not os.path.isdir(subshard_path):
+                continue
+            for name in os.listdir(subshard_path):
+                if is_content_hash(name):
+                    yield name, os.path.join(subshard_path, name)
+
+
+def collect_garbage(root, dry_run=False, grace_period=GRACE_PERIOD):
+    """Удаляет файлы, на которые не ссылается ни одна запись Cover.
+
+    Файлы моложе grace_period секунд пропускаются. Возвращает список
+    хешей удалённых (или подлежащих удалению) файлов.
+    """
+    referenced = {md5_hash for md5_hash, in db.session.query(Cover.md5_hash).distinct()}
+    removed = []
+    for md5_hash, path in iter_blobs(root):
+        if md5_hash in referenced or _recent(path, grace_period):
+            continue
+        removed.append(md5_hash)
+        if not dry_run:
+            os.remove(path)
+    return removed
+
+
+def _normalize_name(name):
+    """Нормализация имени файла обложки для нестрогого сравнения"""
+    return name.lower().replace('__', '_').replace('_', '')
+
+
+class CoverIndex:
+    """Индекс файлов обложек в памяти процесса.
+
+    Сопоставляет имя файла (точное и нормализованное) и хеш содержимого с
+    путём к файлу, чтобы поиск обложки был поиском по словарю, а не обходом
+    каталогов. Промахи запоминаются на negative_ttl секунд, чтобы запросы
+    несуществующих имён не нагружали файловую систему и базу.
+    """
+
+    def __init__(self, upload_folder, static_folder, negative_ttl=30, negative_size=4096):
+        self.upload_folder = upload_folder
+        self.static_folder = static_folder
+        self.negative_ttl = negative_ttl
+        self.negative_size = negative_size
+        self._lock = threading.Lock()
+        self._built = False
+        self._uploads = {}
+        self._static = {}
+        self._static_normalized = {}
+        self._blobs = {}
+        self._etags = {}
+        self._misses = OrderedDict()
+
+    def build(self):
+        """Сканирует каталоги обложек и загружает типы файлов хранилища из базы"""
+        uploads, static, static_normalized, blobs = {}, {}, {}, {}
+        if os.path.isdir(self.upload_folder):
+            for entry in os.scandir(self.upload_folder):
+                if entry.is_file() and not entry.name.startswith('.'):
+                    uploads[entry.name] = entry.path
+        for root, dirs, files in os.walk(self.static_folder):
+            for name in files:
+                path = os.path.join(root, name)
+                if root == self.static_folder:
+                    static[name] = path
+                static_normalized.setdefault(_normalize_name(name), path)
+        # Файлы обложек, не прошедших проверку ('failed'), и файлы без обложек не отдаются
+        mime_types = {}
+        for md5_hash, mime_type, status in (db.session.query(Cover.md5_hash, Cover.mime_type, Cover.status)
+                                            .filter(Cover.status != 'failed').distinct()):
+            if status == 'ready' or md5_hash not in mime_types:
+                mime_types[md5_hash] = mime_type
+        for md5_hash, path in iter_blobs(self.upload_folder):
+            if md5_hash in mime_types:
+                blobs[md5_hash] = (path, mime_types[md5_hash])
+        with self._lock:
+            self._uploads, self._static = uploads, static
+            self._static_normalized, self._blobs = static_normalized, blobs
+            self._misses.clear()
+            self._built = True
+
+    def invalidate(self):
+        """Сбрасывает индекс; он будет перестроен при следующем поиске"""
+        with self._lock:
+            self._built = False
+
+    def add_blob(self, md5_hash, mime_type):
+        with self._lock:
+            self._blobs[md5_hash] = (blob_path(self.upload_folder, md5_hash), mime_type)
+            self._misses.pop(md5_hash, None)
+
+    def discard_blob(self, md5_hash):
+        with self._lock:
+            self._blobs.pop(md5_hash, None)
+
+    def lookup(self, name):
+        """Возвращает CoverFile для имени обложки или None"""
+        if not self._built:
+            self.build()
+        with self._lock:
+            expires = self._misses.get(name)
+            if expires is not None:
+                if expires > time.monotonic():
+                    return None
+                del self._misses[name]
+            found = self._find(name)
+        stat = self._stat(found[0]) if found else None
+        if stat is None:
+            found = self._find_new_blob(name)
+            stat = self._stat(found[0]) if found else None
+        if stat is None:
+            self._remember_miss(name)
+            return None
+        path, mime_type = found
+        return CoverFile(path, mime_type, self._etag(path, stat), stat.st_mtime)
+
+    @staticmethod
+    def _stat(path):
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
+
+    def _etag(self, path, stat):
+        """Хеш содержимого файла; для файлов вне хранилища считается один раз"""
+        name = os.path.basename(path)
+        if is_content_hash(name) and os.path.dirname(path).endswith(os.path.join(name[:2], name[2:4])):
+            return name
+        cached = self._etags.get(path)
+        if cached and cached[0] == stat.st_mtime:
+            return cached[1]
+        etag = file_md5(path)
+        with self._lock:
+            self._etags[path] = (stat.st_mtime, etag)
+        return etag
+
+    def _find(self, name):
+        if name in self._blobs:
+            return self._blobs[name]
+        if name in self._uploads:
+            return self._uploads[name], None
+        if name in self._static:
+            return self._static[name], None
+        path = self._static_normalized.get(_normalize_name(name))
+        return (path, None) if path else None
+
+    def _find_new_blob(self, name):
+        # Файл мог появиться в хранилище после построения индекса,
+        # например при загрузке через другой процесс
+        if not is_content_hash(name):
+            return None
+        path = blob_path(self.upload_folder, name)
+        if not os.path.exists(path):
+            self.discard_blob(name)
+            return None
+        # Тип, определённый при проверке, важнее типа по расширению
+        mime_type = (db.session.query(Cover.mime_type)
+                     .filter(Cover.md5_hash == name, Cover.status != 'failed')
+                     .order_by(Cover.status != 'ready').limit(1).scalar())
+        if mime_type is None:
+            return None
+        self.add_blob(name, mime_type)
+        return path, mime_type
+
+    def _remember_miss(self, name):
+        with self._lock:
+            self._misses[name] = time.monotonic() + self.negative_ttl
+            self._misses.move_to_end(name)
+            while len(self._misses) > self.negative_size:
+                self._misses.popitem(last=False)
@@ -0,0 +1,189 @@
+"""Настройка движка SQLAlchemy: пул соединений, тайм-ауты запросов, метрики.
+
+Приложение работает в нескольких воркерах gunicorn, а число соединений
+PostgreSQL ограничено, поэтому размер пула задаётся явно: воркер держит
+не больше pool_size + max_overflow соединений.
+
+Режимы пула (DB_POOLER):
+    ''            — собственный пул процесса (QueuePool с метриками);
+    'transaction' — внешний пулер (PgBouncer в режиме transaction): пул
+                    процесса не нужен (NullPool), а тайм-аут задаётся
+                    SET LOCAL в каждой транзакции, потому что параметры
+                    подключения пулер серверу не передаёт.
+
+После fork (gunicorn --preload) дочерний процесс не должен пользоваться
+соединениями родителя: они сбрасываются без закрытия сокетов родителя.
+"""
+import os
+import threading
+import time
+from sqlalchemy import event, exc
+from sqlalchemy.pool import NullPool, QueuePool
+
+POOLER_MODES = ('', 'transaction')
+
+
+class PoolMetrics:
+    """Счётчики пула соединений текущего процесса"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checked_out = 0
+            self.checkouts = 0
+            self.connects = 0
+            self.waits = 0
+            self.wait_seconds = 0.0
+            self.timeouts = 0
+            self.invalidations = 0
+
+    def add(self, name, value=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'checked_out': self.checked_out,
+                'checkouts': self.checkouts,
+                'connects': self.connects,
+                'waits': self.waits,
+                'wait_seconds': round(self.wait_seconds, 6),
+                'timeouts': self.timeouts,
+                'invalidations': self.invalidations,
+            }
+
+
+pool_metrics = PoolMetrics()
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool, считающий ожидания свободного соединения.
+
+    Ожидание — запрос соединения, когда все pool_size + max_overflow заняты.
+    """
+
+    def _do_get(self):
+        exhausted = self._max_overflow > -1 and self._overflow >= self._max_overflow and self._pool.empty()
+        if not exhausted:
+            return super()._do_get()
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            pool_metrics.add('timeouts')
+            raise
+        finally:
+            pool_metrics.add('waits')
+            pool_metrics.add('wait_seconds', time.perf_counter() - started)
+
+
+def normalize_url(url):
+    """Приводит схему postgres:// (Render, Heroku) к postgresql://"""
+    if url.startswith('postgres://'):
+        return 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def engine_options(url, pool_size=5, max_overflow=10, pool_timeout=30, pool_recycle=1800,
+                   pre_ping=True, statement_timeout=0, pooler=''):
+    """Параметры create_engine (SQLALCHEMY_ENGINE_OPTIONS).
+
+    statement_timeout — в миллисекундах, 0 — без ограничения; действует
+    только на PostgreSQL.
+    """
+    if pooler not in POOLER_MODES:
+        raise ValueError(f"Неизвестный режим пулера: {pooler}")
+    options = {}
+    if pooler == 'transaction':
+        options['poolclass'] = NullPool
+    else:
+        options.update(
+            poolclass=MeteredQueuePool,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_timeout=pool_timeout,
+            pool_recycle=pool_recycle,
+            pool_pre_ping=pre_ping,
+        )
+    if url.startswith('postgresql') and statement_timeout and not pooler:
+        options['connect_args'] = {'options': f'-c statement_timeout={int(statement_timeout)}'}
+    return options
+
+
+def init_app(app, db):
+    """Подключает метрики, тайм-аут для внешнего пулера и сброс пула после fork"""
+    with app.app_context():
+        engine = db.engine
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        pool_metrics.add('connects')
+
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        pool_metrics.add('checkouts')
+        pool_metrics.add('checked_out')
+
+    @event.listens_for(engine, 'checkin')
+    def on_checkin(dbapi_connection, connection_record):
+        pool_metrics.add('checked_out', -1)
+
+    @event.listens_for(engine, 'invalidate')
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        pool_metrics.add('invalidations')
+
+    statement_timeout = app.config.get('DB_STATEMENT_TIMEOUT', 0)
+    if app.config.get('DB_POOLER') == 'transaction' and statement_timeout and engine.dialect.name == 'postgresql':
+        @event.listens_for(engine, 'begin')
+        def set_statement_timeout(connection):
+            # SET LOCAL живёт до конца транзакции и не переходит с серверным
+            # соединением пулера к другому клиенту
+            cursor = connection.connection.cursor()
+            try:
+                cursor.execute(f"SET LOCAL statement_timeout = {int(statement_timeout)}")
+            finally:
+                cursor.close()
+
+    def after_fork():
+        engine.dispose(close=False)
+        pool_metrics.reset()
+
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=after_fork)
+    return engine
+
+
+def pool_status(engine):
+    """Состояние пула и счётчики для /metrics/db"""
+    pool = engine.pool
+    status = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update(size=pool.size(), idle=pool.checkedin(), overflow=max(pool.overflow(), 0),
+                      max_overflow=pool._max_overflow, timeout=pool.timeout())
+    status.update(pool_metrics.snapshot())
+    return status
+
+
+# Показатели пула для /metrics: ключ pool_status, имя метрики, тип, описание
+POOL_SAMPLES = (
+    ('size', 'app_db_pool_size', 'gauge', 'Размер пула соединений'),
+    ('checked_out', 'app_db_pool_checked_out', 'gauge', 'Выданные из пула соединения'),
+    ('overflow', 'app_db_pool_overflow', 'gauge', 'Соединения сверх размера пула'),
+    ('connects', 'app_db_pool_connects_total', 'counter', 'Открытые соединения'),
+    ('checkouts', 'app_db_pool_checkouts_total', 'counter', 'Выдачи соединений из пула'),
+    ('waits', 'app_db_pool_waits_total', 'counter', 'Ожидания свободного соединения'),
+    ('wait_seconds', 'app_db_pool_wait_seconds_total', 'counter', 'Время ожидания свободного соединения'),
+    ('timeouts', 'app_db_pool_timeouts_total', 'counter', 'Ожидания, закончившиеся тайм-аутом'),
+    ('invalidations', 'app_db_pool_invalidations_total', 'counter', 'Закрытые из-за ошибок соединения'),
+)
+
+
+def pool_samples(engine):
+    """Показатели пула в виде (имя, тип, описание, значение) для instrumentation"""
+    status = pool_status(engine)
+    return [(metric, kind, description, status[key])
+            for key, metric, kind, description in POOL_SAMPLES if key in status]
@@ -0,0 +1,127 @@
+"""Потоковая выгрузка книг, рецензий и подборок в JSONL или CSV.
+
+Строки читаются курсором на стороне сервера (yield_per) порциями по
+batch_size, связанные данные (жанры книг, книги подборок) догружаются
+одним запросом на порцию, а результат отдаётся генератором строк. Память
+не растёт с размером таблицы. Выгрузка идёт по возрастанию id;
+инкрементальная выгрузка продолжается с after_id (последнего выгруженного
+id) и/или с момента since по created_at.
+"""
+import csv
+import io
+import json
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import select
+from models import db, Book, Genre, Review, Collection, book_genre, book_collection
+
+BATCH_SIZE = 1000
+LIST_SEPARATOR = ';'
+
+
+def _book_genres(book_ids):
+    genres = defaultdict(list)
+    rows = (db.session.query(book_genre.c.book_id, Genre.name)
+            .join(Genre, Genre.id == book_genre.c.genre_id)
+            .filter(book_genre.c.book_id.in_(book_ids))
+            .order_by(Genre.name))
+    for book_id, name in rows:
+        genres[book_id].append(name)
+    return genres
+
+
+def _collection_books(collection_ids):
+    books = defaultdict(list)
+    rows = (db.session.query(book_collection.c.collection_id, book_collection.c.book_id)
+            .filter(book_collection.c.collection_id.in_(collection_ids))
+            .order_by(book_collection.c.book_id))
+    for collection_id, book_id in rows:
+        books[collection_id].append(book_id)
+    return books
+
+
+# Набор: (модель, выгружаемые столбцы, поле со связанными данными и функция их загрузки)
+DATASETS = {
+    'books': (Book, (Book.id, Book.title, Book.author, Book.year, Book.publisher, Book.pages,
+                     Book.description, Book.review_count, Book.rating_sum),
+              'genres', _book_genres),
+    'reviews': (Review, (Review.id, Review.book_id, Review.user_id, Review.rating,
+                         Review.text, Review.created_at),
+                None, None),
+    'collections': (Collection, (Collection.id, Collection.name, Collection.user_id,
+                                 Collection.created_at),
+                    'book_ids', _collection_books),
+}
+
+FORMATS = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def fieldnames(dataset):
+    _, columns, related_field, _ = DATASETS[dataset]
+    names = [column.key for column in columns]
+    return names + [related_field] if related_field else names
+
+
+def iter_records(dataset, after_id=None, since=None, batch_size=BATCH_SIZE):
+    """Перебирает записи набора в виде словарей по возрастанию id.
+
+    Ошибки параметров (ValueError) возникают сразу, а не при первой записи.
+    """
+    model, columns, _, _ = DATASETS[dataset]
+    statement = select(*columns).order_by(model.id)
+    if after_id is not None:
+        statement = statement.where(model.id > after_id)
+    if since is not None:
+        if not hasattr(model, 'created_at'):
+            raise ValueError(f"У набора {dataset} нет даты создания")
+        statement = statement.where(model.created_at >= since)
+    return _iterate(dataset, statement.execution_options(stream_results=True, yield_per=batch_size))
+
+
+def _iterate(dataset, statement):
+    _, _, related_field, load_related = DATASETS[dataset]
+    for rows in db.session.execute(statement).partitions():
+        related = load_related([row.id for row in rows]) if load_related else None
+        for row in rows:
+            record = row._asdict()
+            if related is not None:
+                record[related_field] = related.get(row.id, [])
+            yield record
+
+
+def _plain(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def to_jsonl(records):
+    for record in records:
+        yield json.dumps({name: _plain(value) for name, value in record.items()}, ensure_ascii=False) + '\n'
+
+
+def to_csv(records, names):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=names)
+    writer.writeheader()
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    for record in records:
+        writer.writerow({
+            name: LIST_SEPARATOR.join(map(str, value)) if isinstance(value, list) else _plain(value)
+            for name, value in record.items()
+        })
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def render(dataset, fmt, records):
+    """Генератор строк выгрузки в формате fmt"""
+    if fmt == 'csv':
+        return to_csv(records, fieldnames(dataset))
+    return to_jsonl(records)
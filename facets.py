@@ -0,0 +1,166 @@
+"""Фильтрация каталога по жанрам, году, объёму и рейтингу.
+
+Счётчики фасетов считаются агрегирующими запросами по таблицам book и
+book_genre (GROUP BY / SUM(CASE ...)) без загрузки строк книг: боковая
+панель всегда стоит фиксированного числа запросов. Счётчик каждого фасета
+учитывает все остальные выбранные фильтры, кроме своего собственного.
+Результаты кэшируются в процессе на FACET_CACHE_TTL секунд.
+"""
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import and_, case, exists, func
+from models import db, Book, Genre, book_genre
+
+# Диапазоны объёма книги: (подпись, от, до); верхняя граница не включается
+PAGE_RANGES = (
+    ('до 200', None, 200),
+    ('200–400', 200, 400),
+    ('400–700', 400, 700),
+    ('от 700', 700, None),
+)
+
+RATING_THRESHOLDS = (1, 2, 3, 4, 5)
+
+_FACET_CACHE_SIZE = 256
+_facet_cache = OrderedDict()
+_facet_cache_lock = threading.Lock()
+
+
+def _int_arg(args, name):
+    value = args.get(name, type=int)
+    return value if value is not None and value >= 0 else None
+
+
+def _rating_condition(min_rating):
+    # avg >= min_rating без деления: rating_sum >= min_rating * review_count
+    return and_(Book.review_count > 0, Book.rating_sum >= min_rating * Book.review_count)
+
+
+def _pages_condition(low, high):
+    conditions = []
+    if low is not None:
+        conditions.append(Book.pages >= low)
+    if high is not None:
+        conditions.append(Book.pages < high)
+    return and_(*conditions)
+
+
+class CatalogFilter:
+    """Выбранные пользователем фильтры каталога"""
+
+    def __init__(self, genre_ids=(), year_from=None, year_to=None,
+                 pages_from=None, pages_to=None, min_rating=None):
+        self.genre_ids = tuple(sorted(set(genre_ids)))
+        self.year_from = year_from
+        self.year_to = year_to
+        self.pages_from = pages_from
+        self.pages_to = pages_to
+        self.min_rating = min_rating
+
+    @classmethod
+    def from_args(cls, args):
+        min_rating = _int_arg(args, 'min_rating')
+        return cls(
+            genre_ids=args.getlist('genre', type=int),
+            year_from=_int_arg(args, 'year_from'),
+            year_to=_int_arg(args, 'year_to'),
+            pages_from=_int_arg(args, 'pages_from'),
+            pages_to=_int_arg(args, 'pages_to'),
+            min_rating=min_rating if min_rating in RATING_THRESHOLDS else None
+        )
+
+    @property
+    def key(self):
+        return (self.genre_ids, self.year_from, self.year_to,
+                self.pages_from, self.pages_to, self.min_rating)
+
+    @property
+    def is_empty(self):
+        return not self.genre_ids and all(value is None for value in self.key[1:])
+
+    def conditions(self, exclude=None):
+        """Условия WHERE для выборки книг, кроме условий фасета exclude"""
+        conditions = []
+        if self.genre_ids and exclude != 'genre':
+            conditions.append(exists().where(and_(
+                book_genre.c.book_id == Book.id,
+                book_genre.c.genre_id.in_(self.genre_ids)
+            )))
+        if exclude != 'year':
+            if self.year_from is not None:
+                conditions.append(Book.year >= self.year_from)
+            if self.year_to is not None:
+                conditions.append(Book.year <= self.year_to)
+        if exclude != 'pages' and (self.pages_from is not None or self.pages_to is not None):
+            conditions.append(_pages_condition(self.pages_from, self.pages_to))
+        if self.min_rating is not None and exclude != 'rating':
+            conditions.append(_rating_condition(self.min_rating))
+        return conditions
+
+    def apply(self, query):
+        return query.filter(*self.conditions())
+
+    def url_args(self, **overrides):
+        """Параметры фильтра для url_for; overrides заменяют (None — убирают) значения"""
+        args = {'genre': list(self.genre_ids)} if self.genre_ids else {}
+        for name in ('year_from', 'year_to', 'pages_from', 'pages_to', 'min_rating'):
+            value = getattr(self, name)
+            if value is not None:
+                args[name] = value
+        args.update(overrides)
+        return {name: value for name, value in args.items() if value is not None}
+
+
+def facet_counts(catalog_filter, ttl=60):
+    """Счётчики всех фасетов для текущего набора фильтров"""
+    key = catalog_filter.key
+    now = time.monotonic()
+    with _facet_cache_lock:
+        cached = _facet_cache.get(key)
+        if cached and cached[0] > now:
+            _facet_cache.move_to_end(key)
+            return cached[1]
+
+    genre_counts = dict(
+        db.session.query(book_genre.c.genre_id, func.count())
+        .join(Book, Book.id == book_genre.c.book_id)
+        .filter(*catalog_filter.conditions(exclude='genre'))
+        .group_by(book_genre.c.genre_id)
+    )
+    genres = [
+        (genre_id, name, genre_counts.get(genre_id, 0))
+        for genre_id, name in db.session.query(Genre.id, Genre.name).order_by(Genre.name)
+    ]
+
+    decade = (Book.year // 10) * 10
+    decades = [
+        (decade_start, count)
+        for decade_start, count in db.session.query(decade, func.count(Book.id))
+        .filter(*catalog_filter.conditions(exclude='year'))
+        .group_by(decade)
+        .order_by(decade.desc())
+    ]
+
+    rating_row = db.session.query(*[
+        func.coalesce(func.sum(case((_rating_condition(threshold), 1), else_=0)), 0)
+        for threshold in RATING_THRESHOLDS
+    ]).filter(*catalog_filter.conditions(exclude='rating')).one()
+
+    pages_row = db.session.query(*[
+        func.coalesce(func.sum(case((_pages_condition(low, high), 1), else_=0)), 0)
+        for _, low, high in PAGE_RANGES
+    ]).filter(*catalog_filter.conditions(exclude='pages')).one()
+
+    counts = {
+        'genres': genres,
+        'decades': decades,
+        'ratings': list(zip(RATING_THRESHOLDS, rating_row)),
+        'pages': [(label, low, high, count) for (label, low, high), count in zip(PAGE_RANGES, pages_row)],
+    }
+    with _facet_cache_lock:
+        _facet_cache[key] = (now + ttl, counts)
+        _facet_cache.move_to_end(key)
+        while len(_facet_cache) > _FACET_CACHE_SIZE:
+            _facet_cache.popitem(last=False)
+    return counts
@@ -0,0 +1,51 @@
+"""Настройки gunicorn; читаются автоматически при запуске из каталога приложения.
+
+Тип воркера задаёт GUNICORN_WORKER_CLASS:
+    sync    — один запрос на процесс: медленный клиент (долгая загрузка
+              обложки, медленное чтение выгрузки) занимает весь воркер;
+    gthread — GUNICORN_THREADS потоков на процесс (по умолчанию);
+    gevent  — до GUNICORN_WORKER_CONNECTIONS соединений на процесс в
+              гринлетах; нужен пакет gevent, а для PostgreSQL — psycogreen,
+              иначе запросы psycopg2 блокируют весь воркер.
+
+Число воркеров gunicorn берёт из WEB_CONCURRENCY, адрес — из PORT.
+Пул соединений с базой (DB_POOL_SIZE + DB_MAX_OVERFLOW) должен покрывать
+число одновременных запросов воркера — при старте воркера это проверяется.
+"""
+import os
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 8 if worker_class == 'gthread' else 1))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 100))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '0') == '1'
+
+
+def post_fork(server, worker):
+    if server.cfg.worker_class_str == 'gevent' and os.environ.get('DATABASE_URL', '').startswith('postgres'):
+        try:
+            from psycogreen.gevent import patch_psycopg
+        except ImportError:
+            worker.log.warning("psycogreen не установлен: запросы к PostgreSQL будут блокировать воркер gevent")
+        else:
+            patch_psycopg()
+
+
+def post_worker_init(worker):
+    """Проверяет, что пул соединений не меньше числа одновременных запросов воркера"""
+    from app import app
+
+    worker_type = worker.cfg.worker_class_str
+    if worker_type == 'gthread':
+        concurrency = worker.cfg.threads
+    elif worker_type in ('gevent', 'eventlet'):
+        concurrency = worker.cfg.worker_connections
+    else:
+        concurrency = 1
+    capacity = app.config['DB_POOL_SIZE'] + app.config['DB_MAX_OVERFLOW']
+    if not app.config['DB_POOLER'] and capacity < concurrency:
+        worker.log.warning(
+            f"Воркер {worker_type} обслуживает до {concurrency} запросов одновременно, а пул соединений — "
+            f"до {capacity}: остальные запросы будут ждать соединения (DB_POOL_SIZE, DB_MAX_OVERFLOW)"
+        )
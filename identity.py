@@ -0,0 +1,130 @@
+"""Текущий пользователь и его роль без запросов к базе на каждый запрос.
+
+load_user() Flask-Login возвращает снимок пользователя вместе с ролью,
+загруженный одним запросом и закэшированный на IDENTITY_CACHE_TTL секунд.
+Кэш сбрасывается после commit, изменившего пользователя или роль. Роли
+сравниваются по id, которые определяются по названиям один раз.
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from flask import g
+from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import db, User, Role, Collection
+from permissions import ADMIN_ROLE, MODERATOR_ROLE, USER_ROLE, permissions_for
+
+RoleSnapshot = namedtuple('RoleSnapshot', 'id name')
+
+
+class RoleIds:
+    """id ролей по их названиям; загружаются при первом обращении"""
+
+    NAMES = {'admin': ADMIN_ROLE, 'moderator': MODERATOR_ROLE, 'user': USER_ROLE}
+
+    def __init__(self):
+        self._ids = None
+
+    def load(self):
+        ids = dict(db.session.query(Role.name, Role.id))
+        self._ids = {attr: ids.get(name) for attr, name in self.NAMES.items()}
+
+    def invalidate(self):
+        self._ids = None
+
+    def __getattr__(self, attr):
+        if attr not in RoleIds.NAMES:
+            raise AttributeError(attr)
+        if self._ids is None:
+            self.load()
+        return self._ids[attr]
+
+
+roles = RoleIds()
+
+
+class CurrentUser(UserMixin):
+    """Снимок пользователя с ролью, не привязанный к сессии базы"""
+
+    def __init__(self, id, login, last_name, first_name, middle_name, role_id, role_name):
+        self.id = id
+        self.login = login
+        self.last_name = last_name
+        self.first_name = first_name
+        self.middle_name = middle_name
+        self.role_id = role_id
+        self.role = RoleSnapshot(role_id, role_name)
+        self.permissions = permissions_for(role_name)
+
+    @property
+    def collections(self):
+        """Подборки пользователя; загружаются один раз за запрос"""
+        if 'user_collections' not in g:
+            g.user_collections = Collection.query.filter_by(user_id=self.id).all()
+        return g.user_collections
+
+
+class IdentityCache:
+    """Кэш снимков пользователей по id с ограниченным временем жизни"""
+
+    def __init__(self, ttl=60, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        event.listen(Session, 'after_flush', self._after_flush)
+        event.listen(Session, 'after_commit', self._after_commit)
+        event.listen(Session, 'after_rollback', self._after_rollback)
+
+    def get(self, user_id):
+        """Снимок пользователя или None, если такого пользователя нет"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] > now:
+                return entry[1]
+        row = (db.session.query(User.id, User.login, User.last_name, User.first_name,
+                                User.middle_name, User.role_id, Role.name)
+               .join(Role, Role.id == User.role_id)
+               .filter(User.id == user_id)
+               .first())
+        if row is None:
+            return None
+        user = CurrentUser(*row)
+        with self._lock:
+            self._entries[user_id] = (now + self.ttl, user)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return user
+
+    def discard(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    @staticmethod
+    def _after_flush(session, flush_context):
+        changed = session.info.setdefault('identity_changes', set())
+        for obj in (*session.new, *session.dirty, *session.deleted):
+            if isinstance(obj, User):
+                changed.add(obj.id)
+            elif isinstance(obj, Role):
+                changed.add(None)
+
+    def _after_commit(self, session):
+        changed = session.info.pop('identity_changes', ())
+        if None in changed:
+            roles.invalidate()
+            self.clear()
+            return
+        for user_id in changed:
+            self.discard(user_id)
+
+    @staticmethod
+    def _after_rollback(session):
+        session.info.pop('identity_changes', None)
@@ -0,0 +1,198 @@
+"""Пакетный импорт каталога книг из CSV или JSONL.
+
+Файл читается построчно и обрабатывается порциями по chunk_size строк:
+жанры берутся из словаря, загруженного один раз, книги и их связи с
+жанрами вставляются многострочными INSERT (на PostgreSQL и SQLite —
+INSERT ... VALUES (...), (...) RETURNING id), каждая порция фиксируется
+отдельной транзакцией. Книга с уже существующими названием, автором и
+годом пропускается, поэтому повторный запуск на том же файле (в том числе
+после прерванного импорта) ничего не дублирует.
+
+Поля записи: title, author, year, publisher, pages, description, genres.
+В CSV жанры перечисляются через «;», в JSONL — списком или строкой.
+"""
+import csv
+import json
+import logging
+import time
+import bleach
+from sqlalchemy import insert, tuple_
+from models import db, Book, Genre, book_genre
+from rendering import render_markdown
+import search
+
+logger = logging.getLogger(__name__)
+
+GENRE_SEPARATOR = ';'
+GENRE_NAME_LENGTH = Genre.__table__.c.name.type.length
+TEXT_FIELDS = ('title', 'author', 'publisher', 'description')
+INT_FIELDS = ('year', 'pages')
+
+# Та же очистка исходного текста, что и bleach.clean() в формах, без
+# создания Cleaner на каждую строку
+_source_cleaner = bleach.Cleaner()
+
+
+class ImportStats:
+    """Счётчики импорта"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.read = 0
+        self.inserted = 0
+        self.existing = 0
+        self.invalid = 0
+        self.genres_created = 0
+
+    @property
+    def rate(self):
+        """Скорость обработки, строк в секунду"""
+        elapsed = time.monotonic() - self.started
+        return self.read / elapsed if elapsed > 0 else 0.0
+
+
+def read_rows(file, fmt):
+    """Перебирает (номер строки, запись) файла; запись None — строку не удалось разобрать"""
+    if fmt == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_number, row if isinstance(row, dict) else None
+
+
+def parse_record(row):
+    """Проверяет и нормализует запись; при ошибке — ValueError"""
+    if row is None:
+        raise ValueError("строка не разобрана")
+    record = {}
+    for name in TEXT_FIELDS:
+        value = str(row.get(name) or '').strip()
+        if not value:
+            raise ValueError(f"не заполнено поле {name}")
+        length = Book.__table__.c[name].type.length
+        if length and len(value) > length:
+            raise ValueError(f"поле {name} длиннее {length} символов")
+        record[name] = value
+    for name in INT_FIELDS:
+        try:
+            record[name] = int(row.get(name))
+        except (TypeError, ValueError):
+            raise ValueError(f"поле {name} должно быть целым числом") from None
+    genres = row.get('genres') or []
+    if isinstance(genres, str):
+        genres = genres.split(GENRE_SEPARATOR)
+    record['genres'] = list(dict.fromkeys(str(name).strip() for name in genres if str(name or '').strip()))
+    if any(len(name) > GENRE_NAME_LENGTH for name in record['genres']):
+        raise ValueError(f"название жанра длиннее {GENRE_NAME_LENGTH} символов")
+    return record
+
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _resolve_genres(records, genre_ids, stats):
+    """Добавляет в базу и в словарь жанры, которых ещё нет"""
+    missing = sorted({name for record in records for name in record['genres']} - genre_ids.keys())
+    if not missing:
+        return
+    genre_table = Genre.__table__
+    rows = db.session.execute(
+        insert(genre_table).returning(genre_table.c.id, genre_table.c.name, sort_by_parameter_order=True),
+        [{'name': name} for name in missing]
+    )
+    for genre_id, name in rows:
+        genre_ids[name] = genre_id
+    stats.genres_created += len(missing)
+
+
+def import_chunk(records, genre_ids, stats, render_html=True):
+    """Вставляет новые книги порции; возвращает их id"""
+    keys = {(record['title'], record['author'], record['year']) for record in records}
+    existing = set(map(tuple,
+        db.session.query(Book.title, Book.author, Book.year)
+        .filter(tuple_(Book.title, Book.author, Book.year).in_(keys))
+    ))
+    new_records = []
+    for record in records:
+        key = (record['title'], record['author'], record['year'])
+        if key in existing:
+            stats.existing += 1
+            continue
+        existing.add(key)
+        new_records.append(record)
+    if not new_records:
+        return []
+
+    _resolve_genres(new_records, genre_ids, stats)
+    book_table = Book.__table__
+    book_rows = []
+    for record in new_records:
+        description = _source_cleaner.clean(record['description'])
+        book_rows.append({
+            'title': record['title'],
+            'author': record['author'],
+            'year': record['year'],
+            'publisher': record['publisher'],
+            'pages': record['pages'],
+            'description': description,
+            'description_html': render_markdown(description) if render_html else None,
+        })
+    book_ids = db.session.execute(
+        insert(book_table).returning(book_table.c.id, sort_by_parameter_order=True), book_rows
+    ).scalars().all()
+    links = [
+        {'book_id': book_id, 'genre_id': genre_ids[name]}
+        for book_id, record in zip(book_ids, new_records)
+        for name in record['genres']
+    ]
+    if links:
+        db.session.execute(insert(book_genre), links)
+    # Массовая вставка идёт мимо событий сессии, поэтому индекс обновляется явно
+    search.reindex_books(db.session.connection(), book_ids)
+    stats.inserted += len(book_ids)
+    return book_ids
+
+
+def import_books(file, fmt, chunk_size=1000, progress=None, render_html=True):
+    """Импортирует книги из открытого файла; progress(stats) вызывается после каждой порции.
+
+    При render_html=False HTML описаний не вычисляется (его заполнит
+    `flask render-markdown` или кэш при первом показе).
+    """
+    stats = ImportStats()
+    genre_ids = dict(db.session.query(Genre.name, Genre.id))
+    for chunk in _chunks(read_rows(file, fmt), chunk_size):
+        records = []
+        for line_number, row in chunk:
+            stats.read += 1
+            try:
+                records.append(parse_record(row))
+            except ValueError as error:
+                stats.invalid += 1
+                logger.warning(f"Строка {line_number} пропущена: {error}")
+        if records:
+            try:
+                import_chunk(records, genre_ids, stats, render_html)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+        if progress:
+            progress(stats)
+    return stats
@@ -0,0 +1,232 @@
+"""Метрики запросов и профилирование медленных запросов.
+
+Для каждого запроса записываются время обработки, число и время
+SQL-запросов (события before/after_cursor_execute), время рендера шаблонов
+и размер ответа; гистограммы группируются по endpoint маршрута. Метрики
+отдаются в текстовом формате Prometheus и относятся к текущему процессу:
+каждый воркер gunicorn считает свои, а app_process_id показывает, какой
+воркер ответил на запрос метрик.
+
+Профилировщик включается явно (PROFILE_SAMPLE_RATE > 0): выбранная доля
+запросов выполняется под cProfile, и профиль тех из них, что медленнее
+порога, сохраняется в .prof-файл (смотреть через `python -m pstats`).
+Время потоковых ответов считается до отдачи заголовков.
+"""
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from flask import g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# Имя: (тип, описание, границы корзин гистограммы)
+METRICS = {
+    'app_requests_total': ('counter', 'Обработанные запросы', None),
+    'app_slow_requests_total': ('counter', 'Запросы медленнее SLOW_REQUEST_MS', None),
+    'app_request_duration_seconds': ('histogram', 'Время обработки запроса', LATENCY_BUCKETS),
+    'app_request_sql_queries': ('histogram', 'Число SQL-запросов за запрос', QUERY_COUNT_BUCKETS),
+    'app_request_sql_seconds': ('histogram', 'Время SQL-запросов за запрос', LATENCY_BUCKETS),
+    'app_template_render_seconds': ('histogram', 'Время рендера шаблона', LATENCY_BUCKETS),
+    'app_response_size_bytes': ('histogram', 'Размер ответа', SIZE_BUCKETS),
+}
+
+
+def sample(rate):
+    """True с вероятностью rate — для выборочного отладочного логирования"""
+    return rate >= 1 or (rate > 0 and random.random() < rate)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels, extra=()):
+    pairs = tuple(labels) + tuple(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """Счётчики и гистограммы процесса с метками"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._histograms = {}
+
+    def inc(self, name, labels, value=1):
+        with self._lock:
+            self._counters[name, labels] += value
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[name, labels] = Histogram(METRICS[name][2])
+            histogram.observe(value)
+
+    def render(self, samples=()):
+        """Текстовый формат Prometheus; samples — (имя, тип, описание, значение) извне"""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, (list(h.counts), h.sum, h.count)) for key, h in self._histograms.items()
+            )
+        lines = []
+        for metric, (kind, description, buckets) in METRICS.items():
+            lines += [f'# HELP {metric} {description}', f'# TYPE {metric} {kind}']
+            if kind == 'counter':
+                lines += [f'{metric}{_labels(labels)} {value}'
+                          for (name, labels), value in counters if name == metric]
+                continue
+            for (name, labels), (counts, total, count) in histograms:
+                if name != metric:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(buckets + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    lines.append(f'{metric}_bucket{_labels(labels, (("le", bound),))} {cumulative}')
+                lines.append(f'{metric}_sum{_labels(labels)} {_number(total)}')
+                lines.append(f'{metric}_count{_labels(labels)} {count}')
+        for metric, kind, description, value in samples:
+            lines += [f'# HELP {metric} {description}', f'# TYPE {metric} {kind}', f'{metric} {_number(value)}']
+        return '\n'.join(lines) + '\n'
+
+
+class RequestStats:
+    """Показатели текущего запроса"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.render_started = []
+        self.profiler = None
+
+
+class Instrumentation:
+    """Сбор метрик запросов приложения и выборочное профилирование"""
+
+    def __init__(self, app, engine, slow_request_ms=1000, profile_sample_rate=0.0, profile_folder='profiles'):
+        self.registry = Registry()
+        self.slow_request_ms = slow_request_ms
+        self.profile_sample_rate = profile_sample_rate
+        self.profile_folder = profile_folder
+        # cProfile профилирует один поток, и одновременно работает один профилировщик
+        self._profile_lock = threading.Lock()
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.teardown_request(self._stop_profiler)
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        event.listen(engine, 'handle_error', self._handle_error)
+        before_render_template.connect(self._before_render, app, weak=False)
+        template_rendered.connect(self._after_render, app, weak=False)
+
+    @staticmethod
+    def _current():
+        return g.get('request_stats') if has_request_context() else None
+
+    def _start(self):
+        stats = g.request_stats = RequestStats()
+        if sample(self.profile_sample_rate) and self._profile_lock.acquire(blocking=False):
+            stats.profiler = cProfile.Profile()
+            try:
+                stats.profiler.enable()
+            except ValueError:
+                # Уже работает другой профилировщик (например, отладчик)
+                stats.profiler = None
+                self._profile_lock.release()
+
+    def _finish(self, response):
+        stats = self._current()
+        if stats is None:
+            return response
+        elapsed = time.perf_counter() - stats.started
+        endpoint = (('endpoint', request.endpoint or 'unmatched'),)
+        self.registry.inc('app_requests_total', endpoint + (('method', request.method),
+                                                           ('status', response.status_code)))
+        self.registry.observe('app_request_duration_seconds', endpoint, elapsed)
+        self.registry.observe('app_request_sql_queries', endpoint, stats.sql_queries)
+        self.registry.observe('app_request_sql_seconds', endpoint, stats.sql_seconds)
+        if response.content_length is not None:
+            self.registry.observe('app_response_size_bytes', endpoint, response.content_length)
+        if self.slow_request_ms and elapsed * 1000 >= self.slow_request_ms:
+            self.registry.inc('app_slow_requests_total', endpoint)
+            logger.warning(f"Медленный запрос {request.method} {request.path}: {elapsed * 1000:.0f} мс, "
+                           f"SQL-запросов {stats.sql_queries} ({stats.sql_seconds * 1000:.0f} мс)")
+        return response
+
+    def _stop_profiler(self, exception=None):
+        stats = self._current()
+        if stats is None or stats.profiler is None:
+            return
+        profiler, stats.profiler = stats.profiler, None
+        try:
+            profiler.disable()
+        finally:
+            self._profile_lock.release()
+        elapsed_ms = (time.perf_counter() - stats.started) * 1000
+        if elapsed_ms < self.slow_request_ms:
+            return
+        os.makedirs(self.profile_folder, exist_ok=True)
+        name = f"{request.endpoint or 'unmatched'}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.prof"
+        path = os.path.join(self.profile_folder, name)
+        profiler.dump_stats(path)
+        logger.warning(f"Профиль запроса {request.path} ({elapsed_ms:.0f} мс) сохранён в {path}")
+
+    def _before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('query_started', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        started = connection.info['query_started'].pop()
+        stats = self._current()
+        if stats is not None:
+            stats.sql_queries += 1
+            stats.sql_seconds += time.perf_counter() - started
+
+    @staticmethod
+    def _handle_error(context):
+        # При ошибке after_cursor_execute не вызывается
+        if context.connection is not None and context.connection.info.get('query_started'):
+            context.connection.info['query_started'].pop()
+
+    def _before_render(self, sender, template, context, **extra):
+        stats = self._current()
+        if stats is not None:
+            stats.render_started.append(time.perf_counter())
+
+    def _after_render(self, sender, template, context, **extra):
+        stats = self._current()
+        if stats is not None and stats.render_started:
+            elapsed = time.perf_counter() - stats.render_started.pop()
+            self.registry.observe('app_template_render_seconds', (('template', template.name),), elapsed)
+
+    def render(self, samples=()):
+        process = ('app_process_id', 'gauge', 'PID процесса, отдавшего метрики', os.getpid())
+        return self.registry.render([process, *samples])
@@ -0,0 +1,173 @@
+"""Версионированные миграции схемы базы данных.
+
+Миграции — функции, зарегистрированные декоратором @migration под
+возрастающими номерами версий. Применённые версии записываются в таблицу
+schema_migration; `flask migrate` выполняет те, которых там ещё нет, по
+порядку. Каждая миграция идемпотентна: она проверяет текущее состояние
+схемы, поэтому её можно выполнить и на базе, созданной db.create_all()
+по актуальным моделям.
+
+Индексы на PostgreSQL строятся через CREATE INDEX CONCURRENTLY вне
+транзакции, без блокировки записи в таблицу и без её перезаписи.
+"""
+import logging
+from datetime import datetime
+from sqlalchemy import inspect, text
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS = []
+
+
+class MigrationError(Exception):
+    """Миграцию нельзя применить к текущим данным"""
+
+
+def migration(version, description):
+    """Регистрирует функцию migrate(engine) как миграцию с номером version"""
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return func
+    return decorator
+
+
+def _autocommit(engine):
+    return engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+
+
+def _ensure_version_table(engine):
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migration ("
+            " version VARCHAR(20) PRIMARY KEY,"
+            " description VARCHAR(200) NOT NULL,"
+            " applied_at TIMESTAMP NOT NULL)"
+        ))
+
+
+def applied_versions(engine):
+    _ensure_version_table(engine)
+    with engine.connect() as connection:
+        return {version for version, in connection.execute(text("SELECT version FROM schema_migration"))}
+
+
+def pending(engine):
+    applied = applied_versions(engine)
+    return [item for item in MIGRATIONS if item[0] not in applied]
+
+
+def upgrade(engine, log=logger.info):
+    """Применяет все неприменённые миграции; возвращает их номера"""
+    done = []
+    for version, description, func in pending(engine):
+        log(f"Миграция {version}: {description}")
+        func(engine)
+        with engine.begin() as connection:
+            connection.execute(
+                text("INSERT INTO schema_migration (version, description, applied_at) VALUES (:v, :d, :t)"),
+                {'v': version, 'd': description, 't': datetime.utcnow()}
+            )
+        done.append(version)
+    return done
+
+
+# Операции над схемой
+
+def add_column(engine, table, name, ddl):
+    """Добавляет столбец, если его ещё нет; возвращает True, если столбец добавлен"""
+    columns = {column['name'] for column in inspect(engine).get_columns(table)}
+    if name in columns:
+        return False
+    with engine.begin() as connection:
+        connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+    return True
+
+
+def create_index(engine, name, table, columns, unique=False):
+    """Создаёт индекс, если его ещё нет; на PostgreSQL — CONCURRENTLY"""
+    unique_sql = 'UNIQUE ' if unique else ''
+    column_sql = ', '.join(columns)
+    if engine.dialect.name == 'postgresql':
+        with _autocommit(engine) as connection:
+            # Прерванное построение CONCURRENTLY оставляет нерабочий (INVALID) индекс
+            invalid = connection.execute(text(
+                "SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+                "WHERE c.relname = :name AND NOT i.indisvalid"
+            ), {'name': name}).first()
+            if invalid:
+                connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+            connection.execute(text(
+                f"CREATE {unique_sql}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({column_sql})"
+            ))
+    else:
+        with engine.begin() as connection:
+            connection.execute(text(f"CREATE {unique_sql}INDEX IF NOT EXISTS {name} ON {table} ({column_sql})"))
+
+
+def drop_index(engine, name):
+    if engine.dialect.name == 'postgresql':
+        with _autocommit(engine) as connection:
+            connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+    else:
+        with engine.begin() as connection:
+            connection.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
+
+# Миграции
+
+@migration('0001', 'Столбцы агрегатов рейтинга, статуса обложки и сохранённого HTML')
+def add_denormalized_columns(engine):
+    added_count = add_column(engine, 'book', 'review_count', 'INTEGER NOT NULL DEFAULT 0')
+    added_sum = add_column(engine, 'book', 'rating_sum', 'INTEGER NOT NULL DEFAULT 0')
+    if added_count or added_sum:
+        # Агрегаты существующих рецензий; иначе у всех книг был бы нулевой рейтинг
+        with engine.begin() as connection:
+            connection.execute(text(
+                "UPDATE book SET review_count = totals.review_count, rating_sum = totals.rating_sum "
+                "FROM (SELECT book_id, count(*) AS review_count, coalesce(sum(rating), 0) AS rating_sum "
+                "FROM review GROUP BY book_id) AS totals "
+                "WHERE book.id = totals.book_id"
+            ))
+    add_column(engine, 'cover', 'status', "VARCHAR(20) NOT NULL DEFAULT 'ready'")
+    add_column(engine, 'book', 'description_html', 'TEXT')
+    add_column(engine, 'review', 'text_html', 'TEXT')
+
+
+@migration('0002', 'Индексы по столбцам поиска и уникальность рецензии пользователя на книгу')
+def add_lookup_indexes(engine):
+    # Составные индексы моделей, которые раньше появлялись только в новых базах;
+    # review(book_id) и book(year) покрыты ix_review_book_created и ix_book_year_id
+    create_index(engine, 'ix_book_genre_genre', 'book_genre', ['genre_id', 'book_id'])
+    create_index(engine, 'ix_book_year_id', 'book', ['year', 'id'])
+    create_index(engine, 'ix_review_book_created', 'review', ['book_id', 'created_at', 'id'])
+    create_index(engine, 'ix_review_user', 'review', ['user_id'])
+    create_index(engine, 'ix_cover_md5_hash', 'cover', ['md5_hash'])
+    create_index(engine, 'ix_cover_book', 'cover', ['book_id'])
+    create_index(engine, 'ix_collection_user', 'collection', ['user_id'])
+    create_index(engine, 'ix_book_title', 'book', ['title'])
+
+    with engine.connect() as connection:
+        duplicates = connection.execute(text(
+            "SELECT book_id, user_id FROM review GROUP BY book_id, user_id HAVING count(*) > 1 LIMIT 10"
+        )).all()
+    if duplicates:
+        pairs = ', '.join(f"(книга {book_id}, пользователь {user_id})" for book_id, user_id in duplicates)
+        raise MigrationError(f"Есть повторные рецензии, уникальный индекс не создан: {pairs}. "
+                             "Удалите повторы и запустите миграции снова")
+    create_index(engine, 'uq_review_book_user', 'review', ['book_id', 'user_id'], unique=True)
+    # Неуникальный индекс по тем же столбцам больше не нужен
+    drop_index(engine, 'ix_review_book_user')
+
+
+@migration('0003', 'Длина хеша пароля до 255 символов')
+def widen_password_hash(engine):
+    # Хеш scrypt (162 символа) не помещается в VARCHAR(128); SQLite длину не проверяет
+    if engine.dialect.name == 'postgresql':
+        with engine.begin() as connection:
+            connection.execute(text('ALTER TABLE "user" ALTER COLUMN password_hash TYPE VARCHAR(255)'))
+
+
+@migration('0004', 'Индекс книг подборки')
+def add_collection_books_index(engine):
+    create_index(engine, 'ix_book_collection_collection', 'book_collection', ['collection_id', 'book_id'])
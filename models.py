@@ -1,26 +1,31 @@
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+import passwords
 
 db = SQLAlchemy()
 
 # Таблица для связи книг и жанров (многие ко многим)
 book_genre = db.Table('book_genre',
     db.Column('book_id', db.Integer, db.ForeignKey('book.id', ondelete='CASCADE'), primary_key=True),
-    db.Column('genre_id', db.Integer, db.ForeignKey('genre.id', ondelete='CASCADE'), primary_key=True)
+    db.Column('genre_id', db.Integer, db.ForeignKey('genre.id', ondelete='CASCADE'), primary_key=True),
+    # Фильтр и счётчики фасета по жанру идут от genre_id
+    db.Index('ix_book_genre_genre', 'genre_id', 'book_id')
 )
 
 # Таблица для связи книг и подборок (многие ко многим)
 book_collection = db.Table('book_collection',
     db.Column('book_id', db.Integer, db.ForeignKey('book.id', ondelete='CASCADE'), primary_key=True),
-    db.Column('collection_id', db.Integer, db.ForeignKey('collection.id', ondelete='CASCADE'), primary_key=True)
+    db.Column('collection_id', db.Integer, db.ForeignKey('collection.id', ondelete='CASCADE'), primary_key=True),
+    # Книги подборки и их число ищутся по collection_id (первичный ключ начинается с book_id)
+    db.Index('ix_book_collection_collection', 'collection_id', 'book_id')
 )
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     login = db.Column(db.String(50), unique=True, nullable=False)
-    password_hash = db.Column(db.String(128), nullable=False)
+    password_hash = db.Column(db.String(255), nullable=False)
     last_name = db.Column(db.String(50), nullable=False)
     first_name = db.Column(db.String(50), nullable=False)
     middle_name = db.Column(db.String(50))
@@ -31,10 +36,10 @@ class User(UserMixin, db.Model):
     collections = db.relationship('Collection', backref='user', lazy=True, cascade='all, delete-orphan')
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = passwords.hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return passwords.hasher.verify(self.password_hash, password)
 
 class Role(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -45,39 +50,97 @@ class Role(db.Model):
     users = db.relationship('User', backref='role', lazy=True)
 
 class Book(db.Model):
+    __table_args__ = (
+        # Сортировка каталога по году и keyset-пагинация главной страницы
+        db.Index('ix_book_year_id', 'year', 'id'),
+        db.Index('ix_book_title', 'title'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     description = db.Column(db.Text, nullable=False)
+    # HTML описания, вычисляется при записи (rendering.render_markdown)
+    description_html = db.Column(db.Text)
     year = db.Column(db.Integer, nullable=False)
     publisher = db.Column(db.String(100), nullable=False)
     author = db.Column(db.String(100), nullable=False)
     pages = db.Column(db.Integer, nullable=False)
+    # Агрегаты рецензий, поддерживаются событиями Review (см. ниже)
+    review_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_sum = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     
     # Связи
     cover = db.relationship('Cover', backref='book', uselist=False, cascade='all, delete-orphan')
     reviews = db.relationship('Review', backref='book', lazy=True, cascade='all, delete-orphan')
     genres = db.relationship('Genre', secondary=book_genre, backref=db.backref('books', lazy=True))
 
+    @property
+    def avg_rating(self):
+        """Средняя оценка книги по сохранённым агрегатам"""
+        if not self.review_count:
+            return 0
+        return self.rating_sum / self.review_count
+
 class Genre(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), nullable=False, unique=True)
 
 class Cover(db.Model):
+    __table_args__ = (
+        # Поиск файла и подсчёт ссылок на него (cover_storage)
+        db.Index('ix_cover_md5_hash', 'md5_hash'),
+        db.Index('ix_cover_book', 'book_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
     mime_type = db.Column(db.String(100), nullable=False)
     md5_hash = db.Column(db.String(32), nullable=False)
     book_id = db.Column(db.Integer, db.ForeignKey('book.id', ondelete='CASCADE'), nullable=False)
+    # Состояние фоновой обработки: 'pending', 'ready' или 'failed'
+    status = db.Column(db.String(20), nullable=False, default='ready', server_default='ready')
+
+class Task(db.Model):
+    """Фоновая задача в очереди (см. tasks.py)"""
+    __table_args__ = (
+        db.Index('ix_task_status_run_at', 'status', 'run_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    # 'queued', 'running', 'done' или 'failed'
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_until = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
 class Review(db.Model):
+    __table_args__ = (
+        # Keyset-пагинация рецензий книги от новых к старым
+        db.Index('ix_review_book_created', 'book_id', 'created_at', 'id'),
+        # Одна рецензия пользователя на книгу; по нему же ищется рецензия текущего пользователя
+        db.Index('uq_review_book_user', 'book_id', 'user_id', unique=True),
+        db.Index('ix_review_user', 'user_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     book_id = db.Column(db.Integer, db.ForeignKey('book.id', ondelete='CASCADE'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
     rating = db.Column(db.Integer, nullable=False)
     text = db.Column(db.Text, nullable=False)
+    # HTML рецензии, вычисляется при записи (rendering.render_markdown)
+    text_html = db.Column(db.Text)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
 class Collection(db.Model):
+    __table_args__ = (
+        db.Index('ix_collection_user', 'user_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
@@ -87,4 +150,39 @@ class Collection(db.Model):
     books = db.relationship('Book', secondary=book_collection, backref=db.backref('collections', lazy=True))
     
     def __repr__(self):
-        return f'<Collection {self.name}>' 
\ No newline at end of file
+        return f'<Collection {self.name}>'
+
+
+def _shift_book_rating(connection, book_id, count_delta, rating_delta):
+    """Атомарно изменяет агрегаты рейтинга книги в текущей транзакции"""
+    book_table = Book.__table__
+    connection.execute(
+        book_table.update()
+        .where(book_table.c.id == book_id)
+        .values(
+            review_count=book_table.c.review_count + count_delta,
+            rating_sum=book_table.c.rating_sum + rating_delta
+        )
+    )
+
+
+@event.listens_for(Review, 'after_insert')
+def _review_inserted(mapper, connection, review):
+    _shift_book_rating(connection, review.book_id, 1, review.rating)
+
+
+@event.listens_for(Review, 'after_delete')
+def _review_deleted(mapper, connection, review):
+    _shift_book_rating(connection, review.book_id, -1, -review.rating)
+
+
+@event.listens_for(Review, 'after_update')
+def _review_updated(mapper, connection, review):
+    rating_history = inspect(review).attrs.rating.history
+    book_history = inspect(review).attrs.book_id.history
+    if not rating_history.has_changes() and not book_history.has_changes():
+        return
+    old_rating = rating_history.deleted[0] if rating_history.deleted else review.rating
+    old_book_id = book_history.deleted[0] if book_history.deleted else review.book_id
+    _shift_book_rating(connection, old_book_id, -1, -old_rating)
+    _shift_book_rating(connection, review.book_id, 1, review.rating)
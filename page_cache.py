@@ -0,0 +1,247 @@
+"""Кэш страниц и фрагментов страниц.
+
+Ключ записи включает номер поколения кэша. После commit транзакции, в
+которой изменялись книги, рецензии, обложки или жанры, поколение
+увеличивается, и все прежние записи перестают находиться. Поэтому
+устаревшая страница не переживает commit, изменивший её данные.
+
+Хранилища:
+    MemoryBackend     — LRU в памяти процесса (только для одного процесса);
+    FileSystemBackend — файлы в общем каталоге, подходит для нескольких
+                        процессов на одной машине;
+    RedisBackend      — любой клиент с методами get/set/incr (redis-py или
+                        совместимая заглушка).
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import request, session, make_response
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import Book, Review, Cover, Genre
+
+# Модели, изменение которых делает закэшированные страницы устаревшими
+WATCHED_MODELS = (Book, Review, Cover, Genre)
+
+# Заголовки, которые нельзя отдавать из общего кэша
+_SKIPPED_HEADERS = {'set-cookie', 'content-length'}
+
+
+class MemoryBackend:
+    """LRU-кэш в памяти процесса"""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generation = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def generation(self):
+        return self._generation
+
+    def bump(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+class FileSystemBackend:
+    """Кэш в файлах каталога folder; поколение хранится в отдельном файле"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._generation_path = os.path.join(folder, 'generation')
+
+    def _path(self, key):
+        return os.path.join(self.folder, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _write(self, path, data):
+        os.makedirs(self.folder, exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=self.folder, prefix='.tmp-')
+        try:
+            with os.fdopen(handle, 'wb') as temp_file:
+                temp_file.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as file:
+                expires, value = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return value if expires > time.time() else None
+
+    def set(self, key, value, ttl):
+        self._write(self._path(key), pickle.dumps((time.time() + ttl, value)))
+
+    def generation(self):
+        try:
+            with open(self._generation_path) as file:
+                return int(file.read() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def bump(self):
+        self._write(self._generation_path, str(self.generation() + 1).encode())
+        # Записи прежних поколений больше не будут прочитаны
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and entry.path != self._generation_path and not entry.name.startswith('.'):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+
+class RedisBackend:
+    """Кэш в Redis; записи прежних поколений удаляются по истечении ttl"""
+
+    def __init__(self, client, prefix='page-cache:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        data = self.client.get(self.prefix + key)
+        return pickle.loads(data) if data is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl)
+
+    def generation(self):
+        return int(self.client.get(self.prefix + 'generation') or 0)
+
+    def bump(self):
+        self.client.incr(self.prefix + 'generation')
+
+
+def create_backend(kind, folder=None, url=None, max_entries=1024):
+    """Хранилище по значению настройки PAGE_CACHE; None — кэш выключен"""
+    if not kind:
+        return None
+    if kind == 'memory':
+        return MemoryBackend(max_entries)
+    if kind == 'filesystem':
+        return FileSystemBackend(folder)
+    if kind == 'redis':
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("Для PAGE_CACHE='redis' нужен пакет redis") from None
+        return RedisBackend(redis.Redis.from_url(url))
+    raise ValueError(f"Неизвестное хранилище кэша страниц: {kind}")
+
+
+def current_role():
+    """Роль текущего пользователя для ключа кэша"""
+    if not current_user.is_authenticated:
+        return 'anonymous'
+    return current_user.role_id
+
+
+class PageCache:
+    """Кэш ответов и фрагментов шаблонов с инвалидацией по событиям сессии"""
+
+    def __init__(self, backend=None, ttl=300):
+        self.backend = backend
+        self.ttl = ttl
+        event.listen(Session, 'after_flush', self._after_flush)
+        event.listen(Session, 'do_orm_execute', self._do_orm_execute)
+        event.listen(Session, 'after_commit', self._after_commit)
+        event.listen(Session, 'after_rollback', self._after_rollback)
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def _key(self, *parts):
+        return ':'.join([str(self.backend.generation())] + [str(part) for part in parts])
+
+    def fragment(self, parts, render):
+        """Значение фрагмента по ключу parts; при промахе вычисляется render()"""
+        if not self.enabled:
+            return render()
+        key = self._key('fragment', *parts)
+        value = self.backend.get(key)
+        if value is None:
+            value = render()
+            self.backend.set(key, value, self.ttl)
+        return value
+
+    def page(self, view):
+        """Декоратор: кэширует ответ представления для анонимных GET-запросов"""
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if (not self.enabled or request.method != 'GET'
+                    or current_user.is_authenticated or '_flashes' in session):
+                return view(*args, **kwargs)
+            key = self._key('page', current_role(), request.full_path)
+            cached = self.backend.get(key)
+            if cached is not None:
+                status, headers, body = cached
+                response = make_response(body, status, headers)
+                response.headers['X-Page-Cache'] = 'hit'
+                return response
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.direct_passthrough and not session.modified:
+                headers = [(name, value) for name, value in response.headers
+                           if name.lower() not in _SKIPPED_HEADERS]
+                self.backend.set(key, (response.status_code, headers, response.get_data()), self.ttl)
+                response.headers['X-Page-Cache'] = 'miss'
+            return response
+        return wrapper
+
+    def invalidate(self):
+        if self.enabled:
+            self.backend.bump()
+
+    # События сессии: отмечаем изменения при flush, сбрасываем кэш после commit
+
+    @staticmethod
+    def _after_flush(session, flush_context):
+        if any(isinstance(obj, WATCHED_MODELS)
+               for obj in (*session.new, *session.dirty, *session.deleted)):
+            session.info['page_cache_dirty'] = True
+
+    @staticmethod
+    def _do_orm_execute(orm_execute_state):
+        # Массовые UPDATE/DELETE через ORM не проходят через flush
+        if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+            return
+        mapper = orm_execute_state.bind_mapper
+        if mapper is not None and issubclass(mapper.class_, WATCHED_MODELS):
+            orm_execute_state.session.info['page_cache_dirty'] = True
+
+    def _after_commit(self, session):
+        if session.info.pop('page_cache_dirty', False):
+            self.invalidate()
+
+    @staticmethod
+    def _after_rollback(session):
+        session.info.pop('page_cache_dirty', None)
@@ -0,0 +1,162 @@
+"""Keyset-пагинация (постраничный вывод по курсору).
+
+Вместо OFFSET запрос продолжает выборку строго после последней показанной
+строки, поэтому стоимость любой страницы одинакова и определяется
+составным индексом по ключу сортировки.
+"""
+import base64
+import binascii
+import json
+import time
+from datetime import datetime
+from sqlalchemy import func, text, tuple_
+from models import db, Book, Review
+import queries
+
+REVIEWS_PER_PAGE = 10
+BOOKS_PER_PAGE = 10
+
+# Закэшированное число книг каталога: (значение, момент устаревания)
+_catalog_count_cache = {'value': None, 'expires': 0.0}
+
+
+class KeysetPage:
+    """Страница выборки с непрозрачными курсорами соседних страниц"""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def encode_cursor(*values):
+    """Кодирует значения ключа сортировки в строку для URL"""
+    raw = json.dumps(values, separators=(',', ':'), default=_encode_value)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Декодирует курсор; для пустого или повреждённого курсора возвращает None"""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (binascii.Error, ValueError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Значение {value!r} нельзя поместить в курсор")
+
+
+def review_page(book_id, cursor=None, per_page=REVIEWS_PER_PAGE, exclude_user_id=None):
+    """Страница рецензий книги от новых к старым.
+
+    Использует индекс ix_review_book_created по (book_id, created_at, id).
+    Рецензия exclude_user_id показывается на странице книги отдельно.
+    """
+    query = Review.query.options(*queries.REVIEW_LIST).filter(Review.book_id == book_id)
+    if exclude_user_id is not None:
+        query = query.filter(Review.user_id != exclude_user_id)
+
+    after = decode_cursor(cursor)
+    if after and len(after) == 2:
+        try:
+            created_at, review_id = datetime.fromisoformat(after[0]), int(after[1])
+        except (TypeError, ValueError):
+            created_at = None
+        if created_at is not None:
+            query = query.filter(tuple_(Review.created_at, Review.id) < tuple_(created_at, review_id))
+
+    rows = query.order_by(Review.created_at.desc(), Review.id.desc()).limit(per_page + 1).all()
+    items = rows[:per_page]
+    next_cursor = None
+    if len(rows) > per_page:
+        last = items[-1]
+        next_cursor = encode_cursor(last.created_at, last.id)
+    return KeysetPage(items, next_cursor=next_cursor)
+
+
+def book_page(cursor=None, per_page=BOOKS_PER_PAGE, catalog_filter=None):
+    """Страница каталога, отсортированного по (year, id) по убыванию.
+
+    Курсор хранит направление ('n' — дальше, 'p' — назад) и ключ граничной
+    книги. Выборка опирается на индекс ix_book_year_id.
+    """
+    query = Book.query.options(*queries.BOOK_LIST)
+    if catalog_filter is not None:
+        query = catalog_filter.apply(query)
+    key = tuple_(Book.year, Book.id)
+    position = decode_cursor(cursor)
+    if (not position or len(position) != 3 or position[0] not in ('n', 'p')
+            or not all(isinstance(value, int) for value in position[1:])):
+        position = None
+
+    if position is None:
+        rows = query.order_by(Book.year.desc(), Book.id.desc()).limit(per_page + 1).all()
+        items, has_more = rows[:per_page], len(rows) > per_page
+        has_next, has_prev = has_more, False
+    elif position[0] == 'n':
+        rows = (query.filter(key < tuple_(position[1], position[2]))
+                .order_by(Book.year.desc(), Book.id.desc()).limit(per_page + 1).all())
+        items, has_more = rows[:per_page], len(rows) > per_page
+        has_next, has_prev = has_more, True
+    else:
+        rows = (query.filter(key > tuple_(position[1], position[2]))
+                .order_by(Book.year.asc(), Book.id.asc()).limit(per_page + 1).all())
+        has_more = len(rows) > per_page
+        items = list(reversed(rows[:per_page]))
+        has_next, has_prev = True, has_more
+
+    next_cursor = prev_cursor = None
+    if items and has_next:
+        next_cursor = encode_cursor('n', items[-1].year, items[-1].id)
+    if items and has_prev:
+        prev_cursor = encode_cursor('p', items[0].year, items[0].id)
+    return KeysetPage(items, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+
+def catalog_count(mode='exact', ttl=60, catalog_filter=None):
+    """Число книг в каталоге.
+
+    mode='exact' — COUNT(*) на каждый вызов;
+    mode='cached' — COUNT(*) не чаще раза в ttl секунд на процесс;
+    mode='estimate' — оценка планировщика PostgreSQL из pg_class
+    (на других СУБД работает как 'cached').
+    Для отфильтрованного каталога число всегда считается точно.
+    """
+    if catalog_filter is not None and not catalog_filter.is_empty:
+        return catalog_filter.apply(db.session.query(func.count(Book.id))).scalar()
+    if mode == 'exact':
+        return db.session.query(func.count(Book.id)).scalar()
+
+    now = time.monotonic()
+    if _catalog_count_cache['value'] is not None and now < _catalog_count_cache['expires']:
+        return _catalog_count_cache['value']
+
+    value = None
+    if mode == 'estimate' and db.engine.dialect.name == 'postgresql':
+        estimate = db.session.execute(
+            text("SELECT reltuples::bigint FROM pg_class WHERE oid = 'book'::regclass")
+        ).scalar()
+        # reltuples равен -1 (или 0), пока таблица не проанализирована
+        if estimate and estimate > 0:
+            value = estimate
+    if value is None:
+        value = db.session.query(func.count(Book.id)).scalar()
+
+    _catalog_count_cache['value'] = value
+    _catalog_count_cache['expires'] = now + ttl
+    return value
@@ -0,0 +1,116 @@
+"""Хеширование паролей и ограничение частоты попыток входа.
+
+Политика хеширования — строка метода werkzeug (PASSWORD_HASH_METHOD),
+например 'scrypt:32768:8:1' или 'pbkdf2:sha256:600000'. Метод с
+параметрами записывается в начало хеша, поэтому хеш, созданный по старой
+политике, распознаётся при входе и пересчитывается по новой.
+
+Хеширование выполняется в ограниченном пуле потоков (hashlib отпускает
+GIL на время pbkdf2/scrypt): одновременно считается не больше workers
+хешей на процесс, ещё max_pending ждут очереди, а остальные запросы сразу
+получают HasherBusy, не занимая процессор.
+
+Ограничитель попыток входа — корзина токенов на IP-адрес и на логин,
+проверяемая до поиска пользователя и хеширования. Корзины хранятся в
+памяти процесса, поэтому при нескольких воркерах gunicorn фактический
+предел в число воркеров раз выше.
+"""
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+DEFAULT_METHOD = 'scrypt:32768:8:1'
+
+
+class HasherBusy(Exception):
+    """Очередь хеширования заполнена"""
+
+
+def normalize_method(method):
+    """Запись метода с параметрами по умолчанию, как её сохраняет werkzeug"""
+    name, *args = method.split(':')
+    if name == 'scrypt':
+        defaults = ['32768', '8', '1']
+    elif name == 'pbkdf2':
+        defaults = ['sha256', str(DEFAULT_PBKDF2_ITERATIONS)]
+    else:
+        raise ValueError(f"Неподдерживаемый метод хеширования: {method}")
+    return ':'.join([name] + args + defaults[len(args):])
+
+
+class PasswordHasher:
+    def __init__(self, method=DEFAULT_METHOD, workers=2, max_pending=8):
+        self.configure(method, workers, max_pending)
+
+    def configure(self, method=DEFAULT_METHOD, workers=2, max_pending=8):
+        self.method = normalize_method(method)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            return self._executor.submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """Создан ли хеш по другой политике"""
+        return password_hash.split('$', 1)[0] != self.method
+
+
+hasher = PasswordHasher()
+
+
+class TokenBucket:
+    """Корзины токенов по ключам: rate токенов в секунду, не больше burst"""
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        """Забирает токен ключа; False — попытки исчерпаны"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return allowed
+
+    def retry_after(self, key):
+        """Секунд до появления следующего токена"""
+        with self._lock:
+            tokens, _ = self._buckets.get(key, (self.burst, 0))
+        return max(0, int((1 - tokens) / self.rate) + 1) if self.rate else 60
+
+
+class LoginLimiter:
+    """Ограничение попыток входа по IP-адресу и по логину; 0 в минуту — без ограничения"""
+
+    def __init__(self, per_ip_per_minute=20, per_login_per_minute=5):
+        self.by_ip = TokenBucket(per_ip_per_minute / 60, per_ip_per_minute) if per_ip_per_minute else None
+        self.by_login = TokenBucket(per_login_per_minute / 60, per_login_per_minute) if per_login_per_minute else None
+
+    def allow(self, ip, login):
+        """None — попытка разрешена, иначе через сколько секунд повторить"""
+        if self.by_ip and not self.by_ip.allow(ip):
+            return self.by_ip.retry_after(ip)
+        if self.by_login and login and not self.by_login.allow(login.lower()):
+            return self.by_login.retry_after(login.lower())
+        return None
@@ -0,0 +1,72 @@
+"""Права ролей.
+
+Каждой роли соответствует неизменяемый набор прав (битовая маска
+Permission), вычисленный один раз при импорте. Проверка права — побитовое
+И с маской из снимка текущего пользователя, без запросов и сравнения строк.
+"""
+from enum import IntFlag
+from functools import wraps
+from flask import flash, redirect, url_for
+from flask_login import current_user
+
+ADMIN_ROLE = 'Администратор'
+MODERATOR_ROLE = 'Модератор'
+USER_ROLE = 'Пользователь'
+
+
+class Permission(IntFlag):
+    NONE = 0
+    CREATE_BOOKS = 1
+    EDIT_BOOKS = 2
+    DELETE_BOOKS = 4
+    UPLOAD_COVERS = 8
+    WRITE_REVIEWS = 16
+    MANAGE_COLLECTIONS = 32
+    EXPORT_DATA = 64
+
+
+ROLE_PERMISSIONS = {
+    ADMIN_ROLE: (Permission.CREATE_BOOKS | Permission.EDIT_BOOKS | Permission.DELETE_BOOKS
+                 | Permission.UPLOAD_COVERS | Permission.WRITE_REVIEWS | Permission.EXPORT_DATA),
+    MODERATOR_ROLE: Permission.WRITE_REVIEWS,
+    USER_ROLE: Permission.WRITE_REVIEWS | Permission.MANAGE_COLLECTIONS,
+}
+
+DENIED_MESSAGE = 'У вас недостаточно прав для выполнения данного действия'
+
+
+def permissions_for(role_name):
+    return ROLE_PERMISSIONS.get(role_name, Permission.NONE)
+
+
+def has_permission(user, permission):
+    """Есть ли у пользователя все права из permission"""
+    if not user.is_authenticated:
+        return False
+    granted = getattr(user, 'permissions', None)
+    if granted is None:
+        # Пользователь из базы, а не снимок (например, сразу после login_user)
+        granted = permissions_for(user.role.name)
+    return granted & permission == permission
+
+
+def can(permission):
+    """Проверка права текущего пользователя для шаблонов: can(Permission.EDIT_BOOKS)"""
+    return has_permission(current_user, permission)
+
+
+def permission_required(permission, redirect_endpoint='index', pass_args=()):
+    """Декоратор маршрута: без права — сообщение и переход на redirect_endpoint.
+
+    pass_args — имена аргументов маршрута, передаваемых в url_for.
+    Применяется после login_required.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not has_permission(current_user, permission):
+                flash(DENIED_MESSAGE)
+                return redirect(url_for(redirect_endpoint, **{name: kwargs[name] for name in pass_args}))
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
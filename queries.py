@@ -0,0 +1,29 @@
+"""Профили загрузки связей для страниц приложения.
+
+Все связи в models.py ленивые, поэтому шаблоны, перебирающие книги,
+выполняют по отдельному запросу на каждую обложку, жанр и автора рецензии.
+Профили ниже подгружают нужные связи фиксированным числом запросов
+независимо от количества строк на странице.
+"""
+from sqlalchemy.orm import joinedload, selectinload
+from models import Book, Collection, Review
+
+# Карточки книг на главной странице: обложка и жанры
+BOOK_LIST = (
+    joinedload(Book.cover),
+    selectinload(Book.genres),
+)
+
+# Страница книги: рецензии выводятся постранично (см. REVIEW_LIST)
+BOOK_DETAIL = BOOK_LIST
+
+# Страница рецензий книги вместе с их авторами
+REVIEW_LIST = (
+    joinedload(Review.user),
+)
+
+# Страница подборки: книги подборки с обложками и жанрами
+COLLECTION_DETAIL = (
+    selectinload(Collection.books).joinedload(Book.cover),
+    selectinload(Collection.books).selectinload(Book.genres),
+)
@@ -0,0 +1,60 @@
+"""Преобразование Markdown в безопасный HTML.
+
+HTML описаний книг и рецензий вычисляется при записи и хранится рядом с
+исходным текстом (Book.description_html, Review.text_html). Для старых
+строк, где HTML ещё не сохранён, используется LRU-кэш по хешу текста.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+import bleach
+import markdown
+
+ALLOWED_TAGS = [
+    'a', 'abbr', 'b', 'blockquote', 'br', 'code', 'em', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'hr', 'i', 'li', 'ol', 'p', 'pre', 'strong', 'ul',
+]
+ALLOWED_ATTRIBUTES = {
+    'a': ['href', 'title'],
+    'abbr': ['title'],
+}
+ALLOWED_PROTOCOLS = ['http', 'https', 'mailto']
+
+_CACHE_SIZE = 2048
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+# Создание Markdown и Cleaner дороже самого преобразования короткого текста,
+# а сами объекты не потокобезопасны, поэтому у каждого потока свои
+_local = threading.local()
+
+
+def _renderers():
+    if not hasattr(_local, 'markdown'):
+        _local.markdown = markdown.Markdown()
+        _local.cleaner = bleach.Cleaner(tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES,
+                                        protocols=ALLOWED_PROTOCOLS, strip=True)
+    return _local.markdown, _local.cleaner
+
+
+def render_markdown(text):
+    """Markdown → HTML, очищенный от недопустимых тегов и атрибутов"""
+    converter, cleaner = _renderers()
+    html = converter.reset().convert(text or '')
+    return cleaner.clean(html)
+
+
+def cached_markdown(text):
+    """render_markdown() с LRU-кэшем по хешу исходного текста"""
+    key = hashlib.sha1((text or '').encode('utf-8')).digest()
+    with _cache_lock:
+        html = _cache.get(key)
+        if html is not None:
+            _cache.move_to_end(key)
+            return html
+    html = render_markdown(text)
+    with _cache_lock:
+        _cache[key] = html
+        while len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+    return html
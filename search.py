@@ -0,0 +1,235 @@
+"""Полнотекстовый поиск по каталогу.
+
+Поисковый документ книги собирается из названия, автора, издательства,
+описания и названий жанров и хранится в отдельной индексированной таблице:
+
+* PostgreSQL — book_search с колонкой tsvector (словарь 'russian')
+  и GIN-индексом, ранжирование через ts_rank_cd;
+* SQLite — виртуальная таблица FTS5 book_fts, ранжирование через bm25.
+  В FTS5 нет русского стеммера, поэтому слова приводятся к основе
+  функцией stem() и при индексации, и при поиске.
+
+Документы обновляются в той же транзакции, что и изменения книг
+(событие after_flush), а команда `flask reindex-search` перестраивает
+индекс целиком.
+"""
+import re
+from sqlalchemy import bindparam, event, inspect, select, text
+from sqlalchemy.orm import Session
+from models import db, Book, Genre, book_genre
+import queries
+
+SEARCH_PER_PAGE = 10
+
+# Веса полей: название, автор, издательство, описание, жанры
+_FTS_WEIGHTS = (10.0, 5.0, 2.0, 1.0, 5.0)
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# Окончания русских словоформ, от длинных к коротким
+_RU_ENDINGS = sorted({
+    'иями', 'ями', 'ами', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ией', 'ием',
+    'ах', 'ях', 'ов', 'ев', 'ей', 'ой', 'ый', 'ий', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие',
+    'ом', 'ем', 'ам', 'ям', 'ую', 'юю', 'ия', 'ью',
+    'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й',
+}, key=len, reverse=True)
+
+
+def stem(word):
+    """Грубое приведение русского слова к основе отбрасыванием окончания"""
+    word = word.lower().replace('ё', 'е')
+    if len(word) <= 4:
+        return word
+    for ending in _RU_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+def _stem_text(value):
+    return ' '.join(stem(word) for word in _WORD_RE.findall(value or ''))
+
+
+def _backend():
+    return db.engine.dialect.name
+
+
+def init_search():
+    """Создаёт поисковую таблицу, если её ещё нет.
+
+    Возвращает True, если таблица была создана и её нужно заполнить.
+    """
+    backend = _backend()
+    with db.engine.begin() as connection:
+        if backend == 'postgresql':
+            exists = connection.execute(text("SELECT to_regclass('book_search')")).scalar()
+            if exists:
+                return False
+            connection.execute(text(
+                "CREATE TABLE book_search ("
+                " book_id INTEGER PRIMARY KEY REFERENCES book(id) ON DELETE CASCADE,"
+                " document TSVECTOR NOT NULL)"
+            ))
+            connection.execute(text(
+                "CREATE INDEX ix_book_search_document ON book_search USING GIN (document)"
+            ))
+            return True
+        if backend == 'sqlite':
+            exists = connection.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE name = 'book_fts'"
+            )).scalar()
+            if exists:
+                return False
+            connection.execute(text(
+                "CREATE VIRTUAL TABLE book_fts USING fts5("
+                "title, author, publisher, description, genres,"
+                " tokenize = 'unicode61 remove_diacritics 2')"
+            ))
+            return True
+    return False
+
+
+def reindex_books(connection, book_ids=None):
+    """Перестраивает поисковые документы указанных книг (или всех)"""
+    backend = _backend()
+    if backend == 'postgresql':
+        statement = text(
+            "INSERT INTO book_search (book_id, document) "
+            "SELECT b.id,"
+            " setweight(to_tsvector('russian', b.title), 'A') ||"
+            " setweight(to_tsvector('russian', b.author), 'B') ||"
+            " setweight(to_tsvector('russian', coalesce(string_agg(g.name, ' '), '')), 'B') ||"
+            " setweight(to_tsvector('russian', b.publisher), 'C') ||"
+            " setweight(to_tsvector('russian', b.description), 'D') "
+            "FROM book b "
+            "LEFT JOIN book_genre bg ON bg.book_id = b.id "
+            "LEFT JOIN genre g ON g.id = bg.genre_id "
+            + ("WHERE b.id IN :ids " if book_ids is not None else "") +
+            "GROUP BY b.id "
+            "ON CONFLICT (book_id) DO UPDATE SET document = EXCLUDED.document"
+        )
+        if book_ids is not None:
+            statement = statement.bindparams(bindparam('ids', expanding=True))
+            connection.execute(statement, {'ids': list(book_ids)})
+        else:
+            connection.execute(statement)
+    elif backend == 'sqlite':
+        if book_ids is None:
+            connection.execute(text("DELETE FROM book_fts"))
+        else:
+            _delete_sqlite_documents(connection, book_ids)
+        statement = text(
+            "SELECT b.id, b.title, b.author, b.publisher, b.description,"
+            " group_concat(g.name, ' ') "
+            "FROM book b "
+            "LEFT JOIN book_genre bg ON bg.book_id = b.id "
+            "LEFT JOIN genre g ON g.id = bg.genre_id "
+            + ("WHERE b.id IN :ids " if book_ids is not None else "") +
+            "GROUP BY b.id"
+        )
+        params = {}
+        if book_ids is not None:
+            statement = statement.bindparams(bindparam('ids', expanding=True))
+            params['ids'] = list(book_ids)
+        rows = connection.execute(statement, params).fetchall()
+        if rows:
+            connection.execute(
+                text(
+                    "INSERT INTO book_fts (rowid, title, author, publisher, description, genres) "
+                    "VALUES (:id, :title, :author, :publisher, :description, :genres)"
+                ),
+                [{
+                    'id': row[0],
+                    'title': _stem_text(row[1]),
+                    'author': _stem_text(row[2]),
+                    'publisher': _stem_text(row[3]),
+                    'description': _stem_text(row[4]),
+                    'genres': _stem_text(row[5])
+                } for row in rows]
+            )
+
+
+def _delete_sqlite_documents(connection, book_ids):
+    connection.execute(
+        text("DELETE FROM book_fts WHERE rowid IN :ids").bindparams(bindparam('ids', expanding=True)),
+        {'ids': list(book_ids)}
+    )
+
+
+@event.listens_for(Session, 'after_flush')
+def _sync_search_documents(session, flush_context):
+    """Обновляет поисковые документы книг, изменённых в этом flush"""
+    if _backend() not in ('postgresql', 'sqlite'):
+        return
+    changed = set()
+    deleted = set()
+    renamed_genres = set()
+    for obj in session.new.union(session.dirty):
+        if isinstance(obj, Book):
+            changed.add(obj.id)
+        elif isinstance(obj, Genre) and inspect(obj).attrs.name.history.deleted:
+            # Жанр «грязный» и при изменении состава книг; важно только переименование
+            renamed_genres.add(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, Book):
+            deleted.add(obj.id)
+    if not changed and not deleted and not renamed_genres:
+        return
+    connection = session.connection()
+    if renamed_genres:
+        changed.update(connection.execute(
+            select(book_genre.c.book_id).where(book_genre.c.genre_id.in_(renamed_genres))
+        ).scalars())
+    changed -= deleted
+    if changed:
+        reindex_books(connection, changed)
+    # В PostgreSQL документы удаляются каскадно вместе с книгой
+    if deleted and _backend() == 'sqlite':
+        _delete_sqlite_documents(connection, deleted)
+
+
+def _fts_query(query):
+    """Строит запрос FTS5: все слова обязательны, совпадение по префиксу основы"""
+    terms = [stem(word) for word in _WORD_RE.findall(query)]
+    return ' '.join(f'"{term}"*' for term in terms if term)
+
+
+def search_books(query, page=1, per_page=SEARCH_PER_PAGE):
+    """Ищет книги по запросу; возвращает (книги в порядке релевантности, есть_ли_дальше)"""
+    query = (query or '').strip()
+    if not query:
+        return [], False
+    backend = _backend()
+    offset = (page - 1) * per_page
+    params = {'query': query, 'limit': per_page + 1, 'offset': offset}
+
+    if backend == 'postgresql':
+        rows = db.session.execute(text(
+            "SELECT s.book_id "
+            "FROM book_search s, websearch_to_tsquery('russian', :query) q "
+            "WHERE s.document @@ q "
+            "ORDER BY ts_rank_cd(s.document, q) DESC, s.book_id DESC "
+            "LIMIT :limit OFFSET :offset"
+        ), params).scalars().all()
+    elif backend == 'sqlite':
+        params['query'] = _fts_query(query)
+        if not params['query']:
+            return [], False
+        weights = ', '.join(str(weight) for weight in _FTS_WEIGHTS)
+        rows = db.session.execute(text(
+            "SELECT rowid FROM book_fts WHERE book_fts MATCH :query "
+            f"ORDER BY bm25(book_fts, {weights}), rowid DESC "
+            "LIMIT :limit OFFSET :offset"
+        ), params).scalars().all()
+    else:
+        pattern = f'%{query}%'
+        rows = [book_id for book_id, in db.session.query(Book.id).filter(
+            Book.title.ilike(pattern) | Book.author.ilike(pattern) | Book.description.ilike(pattern)
+        ).order_by(Book.id.desc()).limit(per_page + 1).offset(offset)]
+
+    has_next = len(rows) > per_page
+    book_ids = rows[:per_page]
+    if not book_ids:
+        return [], False
+    books = {book.id: book for book in Book.query.options(*queries.BOOK_LIST).filter(Book.id.in_(book_ids))}
+    return [books[book_id] for book_id in book_ids if book_id in books], has_next
@@ -0,0 +1,142 @@
+"""Очередь фоновых задач на таблице task.
+
+Задача ставится в очередь в той же транзакции, что и изменения, которые
+её порождают, и становится видна обработчику только после commit.
+Обработчики выполняются отдельным процессом (`flask worker`) или пулом
+потоков внутри процесса приложения (TASK_MODE='thread'). Упавшая задача
+повторяется с экспоненциальной задержкой до max_attempts раз.
+"""
+import json
+import logging
+import threading
+import traceback
+from datetime import datetime, timedelta
+from sqlalchemy import or_
+from models import db, Task
+
+logger = logging.getLogger(__name__)
+
+# Время, на которое обработчик захватывает задачу; по его истечении
+# задача зависшего обработчика снова становится доступной
+LEASE = timedelta(minutes=10)
+RETRY_DELAY = 5
+
+_handlers = {}
+_wakeup = threading.Event()
+
+
+class PermanentError(Exception):
+    """Ошибка, после которой задачу бессмысленно повторять"""
+
+
+def handler(kind):
+    """Регистрирует функцию-обработчик задач вида kind"""
+    def decorator(func):
+        _handlers[kind] = func
+        return func
+    return decorator
+
+
+def enqueue(kind, max_attempts=5, **payload):
+    """Добавляет задачу в текущую сессию; она будет выполнена после commit"""
+    task = Task(kind=kind, payload=json.dumps(payload), max_attempts=max_attempts)
+    db.session.add(task)
+    _wakeup.set()
+    return task
+
+
+def _claim():
+    """Захватывает одну готовую к выполнению задачу или возвращает None.
+
+    Захват — условный UPDATE: если другой обработчик успел раньше,
+    он не изменит ни одной строки и берётся следующая кандидатура.
+    """
+    now = datetime.utcnow()
+    ready = or_(
+        (Task.status == 'queued') & (Task.run_at <= now),
+        (Task.status == 'running') & (Task.locked_until < now),
+    )
+    candidates = [task_id for task_id, in db.session.query(Task.id).filter(ready).order_by(Task.run_at).limit(10)]
+    for task_id in candidates:
+        claimed = db.session.query(Task).filter(Task.id == task_id, ready).update({
+            'status': 'running',
+            'attempts': Task.attempts + 1,
+            'locked_until': now + LEASE,
+        }, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return db.session.get(Task, task_id)
+    return None
+
+
+def run_one():
+    """Выполняет одну задачу; возвращает False, если очередь пуста"""
+    task = _claim()
+    if task is None:
+        return False
+    task_id, kind, attempts = task.id, task.kind, task.attempts
+    func = _handlers.get(kind)
+    try:
+        if func is None:
+            raise PermanentError(f"Нет обработчика для задачи {kind}")
+        func(**json.loads(task.payload))
+    except Exception as error:
+        db.session.rollback()
+        permanent = isinstance(error, PermanentError)
+        task = db.session.get(Task, task_id)
+        task.last_error = traceback.format_exc()
+        task.locked_until = None
+        if permanent or attempts >= task.max_attempts:
+            task.status = 'failed'
+            logger.error(f"Задача {kind} #{task_id} не выполнена: {error}")
+        else:
+            task.status = 'queued'
+            task.run_at = datetime.utcnow() + timedelta(seconds=RETRY_DELAY * 2 ** (attempts - 1))
+            logger.warning(f"Задача {kind} #{task_id} будет повторена: {error}")
+        db.session.commit()
+        return True
+    task = db.session.get(Task, task_id)
+    task.status = 'done'
+    task.locked_until = None
+    db.session.commit()
+    return True
+
+
+def run_pending(limit=None):
+    """Выполняет задачи, пока очередь не опустеет; возвращает их число"""
+    count = 0
+    while (limit is None or count < limit) and run_one():
+        count += 1
+    return count
+
+
+def work(app, stop_event=None, poll_interval=1.0):
+    """Цикл обработчика: выполняет задачи и ждёт новых"""
+    stop_event = stop_event or threading.Event()
+    while not stop_event.is_set():
+        with app.app_context():
+            try:
+                processed = run_one()
+            except Exception:
+                logger.exception("Сбой обработчика очереди задач")
+                processed = False
+            finally:
+                db.session.remove()
+        if not processed:
+            _wakeup.wait(poll_interval)
+            _wakeup.clear()
+
+
+_threads = []
+_threads_lock = threading.Lock()
+
+
+def start_threads(app, count):
+    """Запускает пул потоков-обработчиков в текущем процессе (один раз)"""
+    with _threads_lock:
+        if _threads:
+            return
+        for number in range(count):
+            thread = threading.Thread(target=work, args=(app,), name=f'task-worker-{number}', daemon=True)
+            thread.start()
+            _threads.append(thread)
@@ -0,0 +1,53 @@
+"""Общие фикстуры тестов: приложение на временной базе SQLite.
+
+Приложение настраивается переменными окружения при импорте app, поэтому
+они задаются до импорта. База пересоздаётся для каждого набора данных.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB_PATH = os.path.join(tempfile.mkdtemp(prefix='library-tests-'), 'test.db')
+
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+os.environ['PAGE_CACHE'] = ''
+# Быстрый хеш: тестам не нужна стойкость паролей
+os.environ['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+os.environ['LOGIN_RATE_PER_IP'] = '0'
+os.environ['LOGIN_RATE_PER_LOGIN'] = '0'
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='session')
+def app():
+    from app import app
+    app.config['TESTING'] = True
+    return app
+
+
+@pytest.fixture
+def fresh_db(app):
+    """Пустая база со схемой, ролями, жанрами и администратором"""
+    import app as application
+    import facets
+    from models import db
+    from identity import roles
+
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+        if os.path.exists(DB_PATH):
+            os.remove(DB_PATH)
+        roles.invalidate()
+        facets._facet_cache.clear()
+        application.identity_cache.clear()
+        application.cover_index.invalidate()
+        application.init_database()
+        application.seed_database(with_test_books=False)
+        yield db
+        db.session.remove()
+
@@ -0,0 +1,100 @@
+"""Настройка пула соединений и его метрики на SQLite вместо PostgreSQL."""
+import os
+import threading
+
+import pytest
+from sqlalchemy import create_engine, exc, text
+from sqlalchemy.pool import NullPool
+
+import database
+from database import MeteredQueuePool, engine_options, normalize_url, pool_metrics
+
+
+def test_normalize_url():
+    assert normalize_url('postgres://user@host/db') == 'postgresql://user@host/db'
+    assert normalize_url('postgresql://user@host/db') == 'postgresql://user@host/db'
+    assert normalize_url('sqlite:///library.db') == 'sqlite:///library.db'
+
+
+def test_engine_options_for_own_pool():
+    options = engine_options('postgresql://host/db', pool_size=3, max_overflow=2, pool_timeout=7,
+                             pool_recycle=60, pre_ping=False, statement_timeout=5000)
+    assert options['poolclass'] is MeteredQueuePool
+    assert (options['pool_size'], options['max_overflow'], options['pool_timeout']) == (3, 2, 7)
+    assert (options['pool_recycle'], options['pool_pre_ping']) == (60, False)
+    assert options['connect_args'] == {'options': '-c statement_timeout=5000'}
+
+
+def test_engine_options_for_external_pooler():
+    # Тайм-аут за пулером задаётся SET LOCAL в транзакции, а не параметром подключения
+    options = engine_options('postgresql://host/db', statement_timeout=5000, pooler='transaction')
+    assert options == {'poolclass': NullPool}
+
+
+def test_statement_timeout_is_ignored_for_sqlite():
+    assert 'connect_args' not in engine_options('sqlite:///library.db', statement_timeout=5000)
+
+
+def test_unknown_pooler_is_rejected():
+    with pytest.raises(ValueError):
+        engine_options('postgresql://host/db', pooler='session')
+
+
+@pytest.fixture
+def small_engine(tmp_path):
+    url = f"sqlite:///{tmp_path / 'pool.db'}"
+    engine = create_engine(url, **engine_options(url, pool_size=1, max_overflow=0, pool_timeout=0.2))
+    pool_metrics.reset()
+    yield engine
+    engine.dispose()
+
+
+def test_pool_counts_waits_and_timeouts(small_engine):
+    held = small_engine.connect()
+    with pytest.raises(exc.TimeoutError):
+        small_engine.connect()
+    assert pool_metrics.snapshot()['timeouts'] == 1
+
+    threading.Timer(0.05, held.close).start()
+    with small_engine.connect() as connection:
+        assert connection.execute(text('SELECT 1')).scalar() == 1
+    snapshot = pool_metrics.snapshot()
+    assert (snapshot['waits'], snapshot['timeouts']) == (2, 1)
+    assert snapshot['wait_seconds'] > 0
+
+
+def test_pool_status_reports_pool_and_checkouts(app, fresh_db):
+    pool_metrics.reset()
+    with fresh_db.engine.connect() as connection:
+        connection.execute(text('SELECT 1'))
+        status = database.pool_status(fresh_db.engine)
+        assert status['pool'] == 'MeteredQueuePool'
+        assert status['checked_out'] == 1
+    assert database.pool_status(fresh_db.engine)['checked_out'] == 0
+    assert database.pool_status(fresh_db.engine)['checkouts'] >= 1
+
+    response = app.test_client().get('/metrics/db')
+    assert response.status_code == 200
+    assert response.get_json()['size'] == app.config['DB_POOL_SIZE']
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='Нужен os.fork')
+def test_child_process_gets_its_own_pool(app, fresh_db):
+    with fresh_db.engine.connect() as connection:
+        connection.execute(text('SELECT 1'))
+    parent_pool = fresh_db.engine.pool
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # Дочерний процесс: пул сброшен, соединения родителя не используются
+        ok = fresh_db.engine.pool is not parent_pool and pool_metrics.snapshot()['checkouts'] == 0
+        os.write(write_end, b'1' if ok else b'0')
+        os._exit(0)
+    os.close(write_end)
+    result = os.read(read_end, 1)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    assert result == b'1'
+    # В родителе пул по-прежнему рабочий
+    with fresh_db.engine.connect() as connection:
+        assert connection.execute(text('SELECT 1')).scalar() == 1
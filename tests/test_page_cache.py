@@ -0,0 +1,126 @@
+"""Кэш страниц: хранилища и инвалидация после commit.
+
+RedisBackend проверяется на заглушке с методами get/set/incr, как у
+redis-py, поэтому тестам не нужен запущенный Redis.
+"""
+import pytest
+
+from page_cache import MemoryBackend, FileSystemBackend, RedisBackend
+
+
+class FakeRedis:
+    """Заглушка клиента redis-py в памяти"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key) or 0) + 1).encode()
+        return int(self.data[key])
+
+
+@pytest.fixture(params=['memory', 'filesystem', 'redis'])
+def backend(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryBackend(max_entries=2)
+    if request.param == 'filesystem':
+        return FileSystemBackend(str(tmp_path / 'page_cache'))
+    return RedisBackend(FakeRedis())
+
+
+def test_backend_stores_values_and_bumps_generation(backend):
+    assert backend.get('key') is None
+    backend.set('key', {'html': '<p>'}, ttl=60)
+    assert backend.get('key') == {'html': '<p>'}
+    generation = backend.generation()
+    backend.bump()
+    assert backend.generation() == generation + 1
+
+
+def test_expired_entry_is_not_returned(backend):
+    if isinstance(backend, RedisBackend):
+        pytest.skip('Срок жизни записей Redis соблюдает сам сервер')
+    backend.set('key', 'value', ttl=-1)
+    assert backend.get('key') is None
+
+
+def test_memory_backend_evicts_least_recently_used():
+    backend = MemoryBackend(max_entries=2)
+    backend.set('a', 1, ttl=60)
+    backend.set('b', 2, ttl=60)
+    backend.get('a')
+    backend.set('c', 3, ttl=60)
+    assert (backend.get('a'), backend.get('b'), backend.get('c')) == (1, None, 3)
+
+
+@pytest.fixture
+def cached_app(app, fresh_db, monkeypatch, tmp_path):
+    """Приложение с кэшем страниц в файлах и одной книгой"""
+    import app as application
+    from models import Book
+
+    monkeypatch.setattr(application.page_cache, 'backend', FileSystemBackend(str(tmp_path / 'page_cache')))
+    book = Book(title='Первое название', description='Описание', year=2000, publisher='Издательство',
+                author='Автор', pages=100)
+    fresh_db.session.add(book)
+    fresh_db.session.commit()
+    return app, book.id
+
+
+def test_page_is_served_from_cache_until_commit(cached_app, fresh_db):
+    from models import Book
+
+    app, book_id = cached_app
+    client = app.test_client()
+    assert client.get(f'/book/{book_id}').headers['X-Page-Cache'] == 'miss'
+    assert client.get(f'/book/{book_id}').headers['X-Page-Cache'] == 'hit'
+
+    book = fresh_db.session.get(Book, book_id)
+    book.title = 'Второе название'
+    fresh_db.session.rollback()
+    assert client.get(f'/book/{book_id}').headers['X-Page-Cache'] == 'hit'
+
+    book = fresh_db.session.get(Book, book_id)
+    book.title = 'Второе название'
+    fresh_db.session.commit()
+    response = client.get(f'/book/{book_id}')
+    assert response.headers['X-Page-Cache'] == 'miss'
+    assert 'Второе название' in response.get_data(as_text=True)
+
+
+def test_bulk_update_invalidates_cache(cached_app, fresh_db):
+    from models import Book
+
+    app, book_id = cached_app
+    client = app.test_client()
+    client.get(f'/book/{book_id}')
+    Book.query.filter_by(id=book_id).update({'title': 'Массовое изменение'})
+    fresh_db.session.commit()
+    response = client.get(f'/book/{book_id}')
+    assert response.headers['X-Page-Cache'] == 'miss'
+    assert 'Массовое изменение' in response.get_data(as_text=True)
+
+
+def test_catalog_fragment_is_invalidated_by_new_book(cached_app, fresh_db):
+    from models import Book
+
+    app, _ = cached_app
+    client = app.test_client()
+    assert 'Первое название' in client.get('/').get_data(as_text=True)
+    fresh_db.session.add(Book(title='Новая книга', description='Описание', year=2001,
+                              publisher='Издательство', author='Автор', pages=100))
+    fresh_db.session.commit()
+    assert 'Новая книга' in client.get('/').get_data(as_text=True)
+
+
+def test_authenticated_pages_are_not_cached(cached_app):
+    app, book_id = cached_app
+    client = app.test_client()
+    assert client.post('/login', data={'login': 'admin', 'password': 'admin'}).status_code == 302
+    assert 'X-Page-Cache' not in client.get(f'/book/{book_id}').headers
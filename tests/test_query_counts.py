@@ -0,0 +1,97 @@
+"""Число SQL-запросов на страницах списков и карточек.
+
+Связи загружаются профилями из queries.py, поэтому число запросов
+страницы не зависит от числа книг, рецензий и подборок. Тест считает
+запросы (before_cursor_execute) на двух размерах набора данных.
+"""
+import hashlib
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+# Ожидаемое число запросов для вошедшего пользователя при прогретых кэшах
+# процесса (пользователь, роли); счётчики фасетов считаются каждый раз
+EXPECTED = {
+    # Фасеты (5), страница книг с обложками, их жанры, число книг
+    'index': 8,
+    # Книга с обложкой, её жанры, своя рецензия, страница рецензий с авторами
+    'book_detail': 4,
+    # Подборка, её книги, жанры книг
+    'collection_detail': 3,
+    # Подборки пользователя, число книг в них
+    'collections': 2,
+}
+
+PASSWORD = 'password'
+
+
+def populate(db, size):
+    """size книг с обложками и жанрами, size рецензий на первую книгу и size подборок"""
+    from models import User, Book, Genre, Cover, Review, Collection
+    from identity import roles
+    import passwords
+
+    password_hash = passwords.hasher.hash(PASSWORD)
+    reader = User(login='reader', password_hash=password_hash, last_name='Читатель', first_name='Тест',
+                  role_id=roles.user)
+    reviewers = [User(login=f'reviewer{number}', password_hash=password_hash, last_name='Рецензент',
+                      first_name=str(number), role_id=roles.user) for number in range(size)]
+    db.session.add_all([reader, *reviewers])
+    genres = Genre.query.order_by(Genre.id).limit(2).all()
+    books = []
+    for number in range(size):
+        book = Book(title=f'Книга {number}', description=f'Описание {number}', year=1950 + number,
+                    publisher='Издательство', author=f'Автор {number}', pages=100 + number)
+        book.genres.extend(genres)
+        book.cover = Cover(filename=f'{number}.jpg', mime_type='image/jpeg', status='ready',
+                           md5_hash=hashlib.md5(str(number).encode()).hexdigest())
+        books.append(book)
+    db.session.add_all(books)
+    db.session.flush()
+    db.session.add_all(Review(book_id=books[0].id, user_id=reviewer.id, rating=number % 6, text=f'Текст {number}')
+                       for number, reviewer in enumerate(reviewers))
+    db.session.add_all(Review(book_id=book.id, user_id=reviewers[0].id, rating=4, text='Текст')
+                       for book in books[1:])
+    collections = [Collection(name=f'Подборка {number}', user_id=reader.id) for number in range(size)]
+    collections[0].books.extend(books)
+    db.session.add_all(collections)
+    db.session.commit()
+    return books[0].id, collections[0].id
+
+
+@contextmanager
+def count_queries(engine):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+@pytest.mark.parametrize('size', [3, 30])
+def test_statement_count_does_not_grow_with_data(app, fresh_db, monkeypatch, size):
+    monkeypatch.setitem(app.config, 'FACET_CACHE_TTL', 0)
+    book_id, collection_id = populate(fresh_db, size)
+    client = app.test_client()
+    assert client.post('/login', data={'login': 'reader', 'password': PASSWORD}).status_code == 302
+
+    urls = {
+        'index': '/',
+        'book_detail': f'/book/{book_id}',
+        'collection_detail': f'/collection/{collection_id}',
+        'collections': '/collections',
+    }
+    counts = {}
+    for view, url in urls.items():
+        assert client.get(url).status_code == 200
+        with count_queries(fresh_db.engine) as statements:
+            response = client.get(url)
+        assert response.status_code == 200
+        counts[view] = len(statements)
+    assert counts == EXPECTED
@@ -0,0 +1,150 @@
+"""Уменьшенные копии обложек.
+
+Для каждой обложки (по хешу её содержимого) и каждого размера из PRESETS
+копия создаётся один раз с помощью Pillow, перекодируется в WebP или JPEG и
+сохраняется в дисковый кэш. Кэш ограничен по объёму: при превышении
+лимита удаляются давно не использованные файлы (LRU по времени изменения,
+которое обновляется при обращении).
+"""
+import os
+import tempfile
+import threading
+import time
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+
+# Размеры (ширина, высота), в которые вписывается обложка
+PRESETS = {
+    'thumb': (240, 360),
+    'medium': (480, 720),
+}
+
+FORMATS = {
+    'webp': ('WEBP', 'image/webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'image/jpeg', {'quality': 85, 'optimize': True, 'progressive': True}),
+}
+
+# Время изменения файла в кэше обновляется не чаще, чем раз в этот интервал
+_TOUCH_INTERVAL = 60 * 60
+
+
+def webp_supported():
+    return features.check('webp')
+
+
+def inspect_image(path):
+    """Проверяет, что файл — целое изображение, и возвращает его MIME-тип.
+
+    Возвращает None для файлов, которые не являются изображением;
+    ошибки чтения файла (OSError) пробрасываются.
+    """
+    try:
+        with Image.open(path) as image:
+            image.verify()
+            return Image.MIME.get(image.format)
+    except FileNotFoundError:
+        raise
+    except (UnidentifiedImageError, SyntaxError, Image.DecompressionBombError, OSError):
+        return None
+
+
+class ThumbnailCache:
+    """Дисковый кэш уменьшенных копий с ограничением объёма"""
+
+    def __init__(self, folder, max_bytes=256 * 1024 * 1024):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._size = None
+
+    def path(self, content_hash, preset, fmt):
+        name = f'{content_hash}-{preset}.{fmt}'
+        return os.path.join(self.folder, content_hash[:2], name)
+
+    def get(self, source_path, content_hash, preset, fmt):
+        """Путь к уменьшенной копии; создаёт её при первом обращении.
+
+        Возвращает None, если исходный файл не удаётся прочитать как изображение.
+        """
+        path = self.path(content_hash, preset, fmt)
+        if self._touch(path):
+            return path
+        with self._key_lock(path):
+            if self._touch(path):
+                return path
+            try:
+                size = self._render(source_path, path, PRESETS[preset], fmt)
+            except (OSError, UnidentifiedImageError, Image.DecompressionBombError):
+                return None
+        self._account(size)
+        return path
+
+    def _key_lock(self, path):
+        with self._lock:
+            return self._key_locks.setdefault(path, threading.Lock())
+
+    @staticmethod
+    def _touch(path):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return False
+        now = time.time()
+        if now - mtime > _TOUCH_INTERVAL:
+            os.utime(path, (now, now))
+        return True
+
+    def _render(self, source_path, path, box, fmt):
+        pil_format, _, save_options = FORMATS[fmt]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with Image.open(source_path) as image:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail(box, Image.LANCZOS)
+            if pil_format == 'JPEG' and image.mode != 'RGB':
+                image = image.convert('RGB')
+            elif image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA')
+            handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.thumb-')
+            try:
+                with os.fdopen(handle, 'wb') as temp_file:
+                    image.save(temp_file, pil_format, **save_options)
+                os.replace(temp_path, path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+        return os.path.getsize(path)
+
+    def _entries(self):
+        for shard in os.scandir(self.folder) if os.path.isdir(self.folder) else ():
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.is_file() and not entry.name.startswith('.'):
+                    yield entry
+
+    def _account(self, added):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(entry.stat().st_size for entry in self._entries())
+            else:
+                self._size += added
+            if self._size <= self.max_bytes:
+                return
+            self._size = self._evict(int(self.max_bytes * 0.9))
+
+    def _evict(self, target):
+        """Удаляет самые давние файлы, пока объём кэша не станет не больше target"""
+        entries = sorted(
+            ((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in self._entries())
+        )
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        return total